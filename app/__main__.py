@@ -1,20 +1,27 @@
 import random
 import asyncio
 from modules.telegram_client import gather_all_users
-from modules.db_operations import store_data_in_db
+from modules.live import run_daemon
+from modules.coordinator import ChatCoordinator
 from modules.logging_setup import logger
+from modules.metrics import FLOOD_WAIT_SECONDS, start_metrics_server
+from modules.scheduler import SweepParked
 from telethon import TelegramClient
 from telethon.errors import FloodWaitError, SessionPasswordNeededError
 from modules.config import Config
 
-client = TelegramClient(Config.SESSION_NAME, Config.API_ID, Config.API_HASH)
+# flood waits are never slept through inside telethon, the request governor has to see all of them
+client = TelegramClient(Config.SESSION_NAME, Config.API_ID, Config.API_HASH, flood_sleep_threshold=0)
 
 
 async def main():
+    start_metrics_server()
+
     try:
         await client.start()
     except FloodWaitError as e:
         logger.warning(f"Request limit exceeded, waiting {e.seconds} seconds...")
+        FLOOD_WAIT_SECONDS.inc(e.seconds)
         await asyncio.sleep(e.seconds)
         await client.start()
 
@@ -22,23 +29,42 @@ async def main():
         me = await client.get_me()
         worker_id = me.id
 
-        while True:
-            try:
-                user_chat_map, chat_details_map = await gather_all_users(client, worker_id, batch_size=500)
-                break
-            except FloodWaitError as e:
-                logger.warning(f"Request limit exceeded, waiting {e.seconds} seconds...")
-                await asyncio.sleep(e.seconds)
-            except SessionPasswordNeededError:
-                logger.error("Password required for two-factor authentication.")
-                break
-            except Exception as e:
-                logger.error(f"Error collecting data: {e}. Trying again in 10 seconds...")
-                await asyncio.sleep(10)
-
-            await asyncio.sleep(random.uniform(1, 3))
-
-        await store_data_in_db(user_chat_map, chat_details_map)
+        coordinator = None
+        if Config.CHAT_LEASING:
+            coordinator = ChatCoordinator(worker_id)
+            await coordinator.start()
+
+        try:
+            if Config.RUN_MODE == 'daemon':
+                await run_daemon(client, worker_id, batch_size=500, coordinator=coordinator)
+            else:
+                await run_once(worker_id, coordinator)
+        finally:
+            if coordinator:
+                await coordinator.close()
+
+
+async def run_once(worker_id, coordinator=None):
+    while True:
+        try:
+            await gather_all_users(
+                client, worker_id, batch_size=500, coordinator=coordinator
+            )
+            break
+        except SweepParked as e:
+            # the flood wait is already counted by the request governor
+            logger.warning(f"Request limit exceeded, waiting {e.seconds:.0f} seconds...")
+            await coordinator.park(e.seconds)
+            await asyncio.sleep(e.seconds)
+        except SessionPasswordNeededError:
+            logger.error("Password required for two-factor authentication.")
+            break
+        except Exception as e:
+            logger.error(f"Error collecting data: {e}. Trying again in 10 seconds...")
+            await asyncio.sleep(10)
+
+        await asyncio.sleep(random.uniform(1, 3))
+
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,254 @@
+"""
+Incremental export of the collected data to Parquet files for offline analytics.
+
+    python app/export_data.py [--tables messages,user_history,users,user_chat] [--minio] [--keep-local]
+
+Layout under EXPORT_DIR (and the MinIO bucket with --minio):
+
+    messages/chat_id=<id>/day=<YYYY-MM-DD>/<first id>-<last id>.parquet
+    user_history/day=<YYYY-MM-DD>/<first id>-<last id>.parquet
+    users/<run>.parquet, user_chat/<run>.parquet
+
+messages and user_history only export rows added since the watermark of the previous
+run, users and user_chat are written as full snapshots. Rows are read with server-side
+cursors in batches of EXPORT_BATCH_SIZE, so memory use doesn't grow with the tables.
+A run that fails before its watermark is stored is repeated as a whole by the next
+run, overwriting the same files. Edits and deletions of already exported messages are
+not exported again.
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime
+from itertools import groupby
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from modules.config import Config
+from modules.db import async_engine
+from modules.logging_setup import logger
+from modules.models import ExportWatermark, Message, User, UserChat, UserHistory
+
+TABLES = ("messages", "user_history", "users", "user_chat")
+
+MESSAGE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("chat_id", pa.int64()),
+    ("message_id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("message_text", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+    ("edit_date", pa.timestamp("us")),
+    ("reply_to_message_id", pa.int64()),
+    ("forwarded_from_user_id", pa.int64()),
+    ("file_url", pa.string()),
+    ("deleted", pa.bool_())
+])
+
+HISTORY_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("first_name", pa.string()),
+    ("last_name", pa.string()),
+    ("username", pa.string()),
+    ("deleted", pa.bool_()),
+    ("premium", pa.bool_()),
+    ("timestamp", pa.timestamp("us"))
+])
+
+USER_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("username", pa.string()),
+    ("first_name", pa.string()),
+    ("last_name", pa.string()),
+    ("deleted", pa.bool_()),
+    ("premium", pa.bool_())
+])
+
+USER_CHAT_SCHEMA = pa.schema([
+    ("user_id", pa.int64()),
+    ("chat_id", pa.int64())
+])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", default=",".join(TABLES), help="comma separated tables to export")
+    parser.add_argument("--minio", action="store_true", help="upload the files to the MinIO bucket")
+    parser.add_argument("--keep-local", action="store_true", help="keep local files after uploading them")
+    return parser.parse_args()
+
+
+class PartitionedWriter:
+    """writes rows arriving sorted by partition into one Parquet file per partition."""
+
+    def __init__(self, root, schema):
+        self.root = root
+        self.schema = schema
+        self.files = []
+        self._writer = None
+        self._partition = None
+
+    def write(self, partition, file_name, rows):
+        if partition != self._partition:
+            self.close()
+            path = os.path.join(self.root, partition, file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+            self._partition = partition
+            self.files.append(path)
+        self._writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._partition = None
+
+
+def day_of(timestamp):
+    return timestamp.date().isoformat() if timestamp else "unknown"
+
+
+async def get_watermark(connection, name):
+    return await connection.scalar(select(ExportWatermark.last_id).where(ExportWatermark.name == name)) or 0
+
+
+async def store_watermark(connection, name, last_id):
+    stmt = insert(ExportWatermark.__table__).values(name=name, last_id=last_id)
+    await connection.execute(stmt.on_conflict_do_update(
+        index_elements=["name"], set_={"last_id": stmt.excluded.last_id, "exported_at": func.now()}
+    ))
+    await connection.commit()
+
+
+async def stable_upper_bound(connection, table):
+    """
+    highest id of a table that is safe to export. ids are taken from the sequence
+    before commit, so rows of transactions running now could still appear below the
+    current value: wait until every transaction running at this point has finished.
+    """
+    sequence = await connection.scalar(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}
+    )
+    last_id = await connection.scalar(text(f"SELECT last_value FROM {sequence}"))
+    xmax = await connection.scalar(text("SELECT pg_snapshot_xmax(pg_current_snapshot())::text"))
+    await connection.commit()
+
+    while True:
+        running = await connection.scalar(
+            # xid8 has no driver type, the value is passed as text and converted by the server
+            text("SELECT pg_snapshot_xmin(pg_current_snapshot()) < CAST(CAST(:xmax AS text) AS xid8)"),
+            {"xmax": xmax}
+        )
+        await connection.commit()
+        if not running:
+            return last_id
+        await asyncio.sleep(1)
+
+
+async def export_incremental(connection, name, stmt, schema, partition_of, root):
+    """stream rows with lower_id < id <= upper_id and write them partitioned, returns (files, rows, upper id)."""
+    lower_id = await get_watermark(connection, name)
+    upper_id = await stable_upper_bound(connection, name)
+    if upper_id <= lower_id:
+        return [], 0, lower_id
+
+    id_column = stmt.selected_columns.id
+    stmt = stmt.where(id_column > lower_id, id_column <= upper_id)
+    file_name = f"{lower_id + 1}-{upper_id}.parquet"
+
+    writer = PartitionedWriter(os.path.join(root, name), schema)
+    exported = 0
+    try:
+        result = await connection.stream(stmt.execution_options(yield_per=Config.EXPORT_BATCH_SIZE))
+        async for batch in result.mappings().partitions(Config.EXPORT_BATCH_SIZE):
+            for partition, rows in groupby(batch, key=partition_of):
+                rows = [dict(row) for row in rows]
+                writer.write(partition, file_name, rows)
+                exported += len(rows)
+    finally:
+        writer.close()
+        await connection.commit()
+
+    return writer.files, exported, upper_id
+
+
+async def export_snapshot(connection, name, stmt, schema, root, run):
+    path = os.path.join(root, name, f"{run}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    exported = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        result = await connection.stream(stmt.execution_options(yield_per=Config.EXPORT_BATCH_SIZE))
+        async for batch in result.mappings().partitions(Config.EXPORT_BATCH_SIZE):
+            writer.write_table(pa.Table.from_pylist([dict(row) for row in batch], schema=schema))
+            exported += len(batch)
+    await connection.commit()
+
+    return [path], exported
+
+
+async def upload(files, root, keep_local):
+    from modules.minio_client import upload_file
+
+    for path in files:
+        object_name = "export/" + os.path.relpath(path, root).replace(os.sep, "/")
+        await asyncio.to_thread(upload_file, path, object_name)
+        if not keep_local:
+            os.remove(path)
+
+
+async def main():
+    args = parse_args()
+    tables = [table for table in args.tables.split(",") if table]
+    unknown = set(tables) - set(TABLES)
+    if unknown:
+        raise SystemExit(f"unknown tables: {', '.join(sorted(unknown))}")
+
+    root = Config.EXPORT_DIR
+    run = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+
+    async with async_engine.connect() as connection:
+        for table in tables:
+            upper_id = None
+            if table == "messages":
+                stmt = (
+                    select(*(getattr(Message, field.name) for field in MESSAGE_SCHEMA))
+                    .order_by(Message.chat_id, Message.timestamp)
+                )
+                files, exported, upper_id = await export_incremental(
+                    connection, table, stmt, MESSAGE_SCHEMA,
+                    lambda row: f"chat_id={row['chat_id']}/day={day_of(row['timestamp'])}", root
+                )
+            elif table == "user_history":
+                stmt = (
+                    select(*(getattr(UserHistory, field.name) for field in HISTORY_SCHEMA))
+                    .order_by(UserHistory.timestamp)
+                )
+                files, exported, upper_id = await export_incremental(
+                    connection, table, stmt, HISTORY_SCHEMA, lambda row: f"day={day_of(row['timestamp'])}", root
+                )
+            elif table == "users":
+                stmt = select(*(getattr(User, field.name) for field in USER_SCHEMA)).order_by(User.id)
+                files, exported = await export_snapshot(connection, table, stmt, USER_SCHEMA, root, run)
+            else:
+                stmt = select(UserChat.user_id, UserChat.chat_id).order_by(UserChat.chat_id)
+                files, exported = await export_snapshot(connection, table, stmt, USER_CHAT_SCHEMA, root, run)
+
+            if args.minio and files:
+                await upload(files, root, args.keep_local)
+            if upper_id is not None:
+                await store_watermark(connection, table, upper_id)
+
+            logger.info(f"{table}: {exported} rows exported to {len(files)} files.")
+
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
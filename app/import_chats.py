@@ -0,0 +1,233 @@
+"""
+Bulk import of chat assignments from chatlist CSVs (id,title,worker,invite_link_id,access_hash).
+
+    python app/import_chats.py chatlists/chatlist.csv [--workers 111,222] [--resolve]
+
+The file is streamed into a temporary staging table with COPY and merged into chats
+in one statement. Chats without a worker are spread over the workers so that every
+worker ends up with about the same number of chats. With --resolve, chats without a
+title or without a way to reach them are looked up through the telegram client: the
+title is filled in, and public chats get their username as invite_link_id. Invite
+hashes of private chats can't be looked up, they have to come with the CSV.
+"""
+import argparse
+import asyncio
+import heapq
+
+import telethon
+from sqlalchemy import text
+
+from modules.config import Config
+from modules.db import async_engine
+from modules.logging_setup import logger
+from modules.governor import ChatParked, governor
+
+NO_TITLE = "[no title]"
+
+CREATE_STAGING = """
+CREATE TEMPORARY TABLE chats_staging (
+    id TEXT,
+    title TEXT,
+    worker TEXT,
+    invite_link_id TEXT,
+    access_hash TEXT
+) ON COMMIT DROP
+"""
+
+MERGE_CHATS = f"""
+WITH valid AS (
+    SELECT DISTINCT ON (id::BIGINT)
+           id::BIGINT AS id,
+           LEFT(COALESCE(NULLIF(title, ''), '{NO_TITLE}'), 128) AS title,
+           CASE WHEN worker ~ '^-?[0-9]+$' THEN worker::BIGINT END AS worker,
+           NULLIF(LEFT(invite_link_id, 64), '') AS invite_link_id,
+           NULLIF(LEFT(access_hash, 64), '') AS access_hash
+    FROM chats_staging
+    WHERE id ~ '^-?[0-9]+$'
+    ORDER BY id::BIGINT
+)
+INSERT INTO chats (id, title, worker, invite_link_id, access_hash)
+SELECT id, title, worker, invite_link_id, access_hash FROM valid
+ON CONFLICT (id) DO UPDATE SET
+    title = CASE WHEN excluded.title <> '{NO_TITLE}' THEN excluded.title ELSE chats.title END,
+    worker = COALESCE(excluded.worker, chats.worker),
+    invite_link_id = COALESCE(excluded.invite_link_id, chats.invite_link_id),
+    access_hash = COALESCE(excluded.access_hash, chats.access_hash)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv", nargs="+", help="chatlist CSV files with a header row")
+    parser.add_argument("--workers", help="comma separated worker ids, default: known workers")
+    parser.add_argument("--resolve", action="store_true",
+                        help=f"fetch titles of chats stored as {NO_TITLE!r} and usernames of chats without "
+                             f"invite_link_id and access_hash through the telegram client")
+    return parser.parse_args()
+
+
+async def copy_csv(connection, path):
+    """stream one CSV into chats (and chat_leases) through a staging table, returns (rows in file, rows merged)."""
+    raw = await connection.get_raw_connection()
+    async with connection.begin():
+        await connection.execute(text(CREATE_STAGING))
+        status = await raw.driver_connection.copy_to_table(
+            "chats_staging", source=path, format="csv", header=True,
+            columns=["id", "title", "worker", "invite_link_id", "access_hash"]
+        )
+        result = await connection.execute(text(MERGE_CHATS))
+        await connection.execute(text(
+            "INSERT INTO chat_leases (chat_id, worker) SELECT id, worker FROM chats ON CONFLICT DO NOTHING"
+        ))
+    copied = int(status.split()[-1])
+    return copied, result.rowcount
+
+
+async def get_worker_ids(connection):
+    result = await connection.execute(text(
+        "SELECT id FROM workers UNION SELECT DISTINCT worker FROM chats WHERE worker IS NOT NULL"
+    ))
+    return [row[0] for row in result]
+
+
+async def assign_workers(connection, worker_ids=None):
+    """give chats without a worker to the least loaded workers, by default all known workers."""
+    async with connection.begin():
+        if worker_ids is None:
+            worker_ids = await get_worker_ids(connection)
+        if not worker_ids:
+            logger.warning("No workers known, chats without a worker are left unassigned.")
+            return 0
+
+        counts = dict.fromkeys(worker_ids, 0)
+        result = await connection.execute(text(
+            "SELECT worker, count(*) FROM chats WHERE worker = ANY(:workers) GROUP BY worker"
+        ), {"workers": worker_ids})
+        counts.update(dict(result.all()))
+
+        result = await connection.execute(text("SELECT id FROM chats WHERE worker IS NULL ORDER BY id"))
+        chat_ids = [row[0] for row in result]
+        if not chat_ids:
+            return 0
+
+        heap = [(count, worker_id) for worker_id, count in counts.items()]
+        heapq.heapify(heap)
+        assigned = []
+        for _ in chat_ids:
+            count, worker_id = heapq.heappop(heap)
+            assigned.append(worker_id)
+            heapq.heappush(heap, (count + 1, worker_id))
+
+        await connection.execute(text("""
+            UPDATE chats SET worker = v.worker
+            FROM (SELECT unnest(CAST(:ids AS BIGINT[])) AS id, unnest(CAST(:workers AS BIGINT[])) AS worker) v
+            WHERE chats.id = v.id
+        """), {"ids": chat_ids, "workers": assigned})
+        await connection.execute(text("""
+            UPDATE chat_leases SET worker = chats.worker
+            FROM chats
+            WHERE chat_leases.chat_id = chats.id AND chat_leases.worker IS NULL AND chat_leases.lease_expires_at IS NULL
+        """))
+        return len(chat_ids)
+
+
+async def resolve_one(client, peer):
+    """entity of a single chat, None if it can't be resolved."""
+    try:
+        return await governor.call("get_entity", lambda: client.get_entity(peer))
+    except ChatParked:
+        raise
+    except Exception as e:
+        logger.error(f"Error resolving chat {peer}: {e}")
+        return None
+
+
+async def resolve_chats(connection, batch_size=100):
+    """
+    look up untitled chats and chats without invite_link_id and access_hash by username
+    or id, in batches through the request governor. returns the number of chats updated.
+    """
+    result = await connection.execute(text("""
+        SELECT id, invite_link_id, title = :no_title AS untitled FROM chats
+        WHERE title = :no_title OR (invite_link_id IS NULL AND access_hash IS NULL)
+    """), {"no_title": NO_TITLE})
+    chats = result.all()
+    # no transaction is held open while telegram is asked
+    await connection.commit()
+    if not chats:
+        return 0
+
+    titles = {}
+    usernames = {}
+    client = telethon.TelegramClient(
+        Config.SESSION_NAME, Config.API_ID, Config.API_HASH, flood_sleep_threshold=0
+    )
+    async with client:
+        for i in range(0, len(chats), batch_size):
+            batch = chats[i:i + batch_size]
+            # chats.id holds marked ids, which telethon resolves from the session like any peer.
+            # a list is resolved with one request per entity type for ids known to the session
+            peers = [invite_link_id or chat_id for chat_id, invite_link_id, _ in batch]
+            try:
+                entities = await governor.call("get_entity", lambda: client.get_entity(peers))
+            except ChatParked as e:
+                logger.warning(f"Chat lookups are flood limited for {e.seconds:.0f} seconds, stopping.")
+                break
+            except Exception as e:
+                # one stale chat fails the whole list, the others are looked up one by one
+                logger.warning(f"Error resolving {len(batch)} chats starting with {batch[0][0]}, "
+                               f"retrying them one by one: {e}")
+                try:
+                    entities = [await resolve_one(client, peer) for peer in peers]
+                except ChatParked as e:
+                    logger.warning(f"Chat lookups are flood limited for {e.seconds:.0f} seconds, stopping.")
+                    break
+            for (chat_id, invite_link_id, untitled), entity in zip(batch, entities):
+                title = getattr(entity, "title", None)
+                if title and untitled:
+                    titles[chat_id] = title[:128]
+                username = getattr(entity, "username", None)
+                if username and not invite_link_id:
+                    usernames[chat_id] = username[:64]
+
+    chat_ids = list(titles.keys() | usernames.keys())
+    if chat_ids:
+        async with connection.begin():
+            await connection.execute(text("""
+                UPDATE chats SET
+                    title = COALESCE(v.title, chats.title),
+                    invite_link_id = COALESCE(chats.invite_link_id, v.username)
+                FROM (SELECT unnest(CAST(:ids AS BIGINT[])) AS id,
+                             unnest(CAST(:titles AS TEXT[])) AS title,
+                             unnest(CAST(:usernames AS TEXT[])) AS username) v
+                WHERE chats.id = v.id
+            """), {
+                "ids": chat_ids,
+                "titles": [titles.get(chat_id) for chat_id in chat_ids],
+                "usernames": [usernames.get(chat_id) for chat_id in chat_ids]
+            })
+    return len(chat_ids)
+
+
+async def main():
+    args = parse_args()
+
+    async with async_engine.connect() as connection:
+        for path in args.csv:
+            copied, merged = await copy_csv(connection, path)
+            logger.info(f"{path}: {copied} rows copied, {merged} chats inserted or updated, "
+                        f"{copied - merged} rows skipped as invalid or duplicate.")
+
+        worker_ids = [int(worker_id) for worker_id in args.workers.split(",")] if args.workers else None
+        assigned = await assign_workers(connection, worker_ids)
+        logger.info(f"{assigned} chats without a worker assigned.")
+
+        if args.resolve:
+            resolved = await resolve_chats(connection)
+            logger.info(f"{resolved} chats resolved.")
+
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+from datetime import timedelta
+
+from sqlalchemy import func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from .config import Config
+from .coordinator import utc_now
+from .db import AsyncSessionLocal
+from .logging_setup import logger
+from .models import BackfillRange, Chat, ScrapeState
+
+
+def lease_expiry():
+    return utc_now() + timedelta(seconds=Config.LEASE_TTL)
+
+
+async def plan_backfill(chat_id, top_message_id, range_size=None):
+    """
+    split the history of a chat up to top_message_id into ranges of range_size ids.
+    the checkpoint of the chat is moved to top_message_id in the same transaction,
+    so the regular sweep only picks up newer messages.
+    """
+    range_size = range_size or Config.BACKFILL_RANGE_SIZE
+    ranges = [
+        {"chat_id": chat_id, "start_id": start_id, "end_id": min(start_id + range_size, top_message_id + 1),
+         "last_message_id": start_id - 1}
+        for start_id in range(1, top_message_id + 1, range_size)
+    ]
+
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(insert(BackfillRange.__table__).on_conflict_do_nothing(), ranges)
+
+            stmt = insert(ScrapeState.__table__).values(chat_id=chat_id, topic_id=0, last_message_id=top_message_id)
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=["chat_id", "topic_id"],
+                set_={"last_message_id": func.greatest(ScrapeState.__table__.c.last_message_id,
+                                                       stmt.excluded.last_message_id)}
+            ))
+
+    logger.info(f"Chat {chat_id} split into {len(ranges)} backfill ranges up to message {top_message_id}.")
+
+
+async def claim_range(worker_id, chat_id):
+    """lease the newest free range of a chat, ranges this worker held before are taken first."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            now = utc_now()
+            result = await session.execute(
+                select(BackfillRange.start_id, BackfillRange.end_id, BackfillRange.last_message_id)
+                .where(
+                    BackfillRange.chat_id == chat_id,
+                    BackfillRange.done.is_(False),
+                    or_(BackfillRange.lease_expires_at.is_(None), BackfillRange.lease_expires_at < now)
+                )
+                .order_by((BackfillRange.worker == worker_id).desc().nulls_last(), BackfillRange.start_id.desc())
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            backfill_range = result.first()
+            if backfill_range is None:
+                return None
+
+            await session.execute(
+                update(BackfillRange)
+                .where(BackfillRange.chat_id == chat_id, BackfillRange.start_id == backfill_range.start_id)
+                .values(worker=worker_id, lease_expires_at=lease_expiry())
+            )
+            return backfill_range
+
+
+async def get_backfill_chats(chat_ids=None):
+    """chats with unfinished ranges, limited to chat_ids unless ranges are shared between workers."""
+    async with AsyncSessionLocal() as session:
+        pending = select(BackfillRange.chat_id).where(BackfillRange.done.is_(False))
+        if chat_ids is not None:
+            pending = pending.where(BackfillRange.chat_id.in_(chat_ids))
+
+        result = await session.execute(select(Chat).where(Chat.id.in_(pending)))
+        return result.scalars().all()
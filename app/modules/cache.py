@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+from sqlalchemy.future import select
+
+from .config import Config
+from .db import AsyncSessionLocal
+from .logging_setup import logger
+from .metrics import CACHE_LOOKUPS
+from .models import UserChat
+
+
+# lookups are counted locally and published every METRICS_EVERY lookups,
+# a prometheus counter takes a lock on every inc()
+METRICS_EVERY = 1024
+
+
+class LRUSet:
+    """Bounded set of ids, least recently used entries are evicted first."""
+
+    def __init__(self, maxsize, name):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._hits = CACHE_LOOKUPS.labels(cache=name, result="hit")
+        self._misses = CACHE_LOOKUPS.labels(cache=name, result="miss")
+        self._hit_count = 0
+        self._lookup_count = 0
+
+    def __contains__(self, key):
+        found = key in self._items
+        if found:
+            self._items.move_to_end(key)
+            self._hit_count += 1
+        self._lookup_count += 1
+        if self._lookup_count >= METRICS_EVERY:
+            self._publish()
+        return found
+
+    def _publish(self):
+        self._hits.inc(self._hit_count)
+        self._misses.inc(self._lookup_count - self._hit_count)
+        self._hit_count = 0
+        self._lookup_count = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, key):
+        self._items[key] = None
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def discard(self, key):
+        self._items.pop(key, None)
+
+
+class LRUDict(LRUSet):
+    """LRUSet that keeps a value for every key."""
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._items[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self.add(key)
+        self._items[key] = value
+
+
+# ids known to exist in the database, only filled after a successful commit
+known_users = LRUSet(Config.CACHE_MAX_USERS, "users")
+known_chats = LRUSet(Config.CACHE_MAX_CHATS, "chats")
+known_user_chats = LRUSet(Config.CACHE_MAX_USER_CHATS, "user_chats")
+
+
+async def warm_cache(chat_ids):
+    """load chats of the worker and their known members into the cache."""
+    known_chats.update(chat_ids)
+    if not chat_ids:
+        return
+
+    async with AsyncSessionLocal() as session:
+        try:
+            result = await session.execute(
+                select(UserChat.user_id, UserChat.chat_id)
+                .where(UserChat.chat_id.in_(chat_ids))
+                .limit(Config.CACHE_MAX_USER_CHATS)
+            )
+            for user_id, chat_id in result:
+                known_users.add(user_id)
+                known_user_chats.add((user_id, chat_id))
+        except Exception as e:
+            logger.error(f"Error warming cache for chats {chat_ids}: {e}")
+            return
+
+    logger.info(f"Cache warmed with {len(known_users)} users and {len(known_user_chats)} user_chat pairs.")
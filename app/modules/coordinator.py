@@ -0,0 +1,186 @@
+import asyncio
+import math
+from datetime import timedelta
+
+from sqlalchemy import bindparam, func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from .config import Config
+from .db import AsyncSessionLocal
+from .logging_setup import logger
+from .models import Chat, ChatLease, Worker
+
+
+def utc_now():
+    return func.timezone('utc', func.now())
+
+
+class ChatCoordinator:
+    """
+    Leases chats to workers through the chat_leases table.
+
+    Every worker takes free or expired leases with SELECT ... FOR UPDATE SKIP LOCKED
+    until it holds its share of the fleet's backlog (backlog + 1 per chat, so idle
+    chats are spread too), and releases its smallest chats when it holds too much.
+    Leases are extended by a heartbeat, so chats of a dead worker expire after
+    LEASE_TTL seconds, and a flood-waited worker hands all of its chats back.
+    """
+
+    def __init__(self, worker_id, lease_ttl=None):
+        self.worker_id = worker_id
+        self.lease_ttl = timedelta(seconds=lease_ttl or Config.LEASE_TTL)
+        self._heartbeat_task = None
+
+    async def start(self):
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                await session.execute(
+                    insert(ChatLease.__table__)
+                    .from_select(["chat_id", "worker"], select(Chat.id, Chat.worker))
+                    .on_conflict_do_nothing(index_elements=["chat_id"])
+                )
+        await self.heartbeat()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_periodically())
+
+    async def close(self):
+        """stop the heartbeat and let other workers take the chats right away."""
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                await session.execute(
+                    update(ChatLease).where(ChatLease.worker == self.worker_id).values(lease_expires_at=None)
+                )
+
+    async def _heartbeat_periodically(self):
+        while True:
+            await asyncio.sleep(self.lease_ttl.total_seconds() / 3)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Error sending heartbeat for worker {self.worker_id}: {e}")
+
+    async def heartbeat(self):
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                stmt = insert(Worker.__table__).values(id=self.worker_id, heartbeat_at=utc_now())
+                await session.execute(
+                    stmt.on_conflict_do_update(index_elements=["id"], set_={"heartbeat_at": stmt.excluded.heartbeat_at})
+                )
+                await session.execute(
+                    update(ChatLease)
+                    .where(ChatLease.worker == self.worker_id, ChatLease.lease_expires_at.is_not(None))
+                    .values(lease_expires_at=utc_now() + self.lease_ttl)
+                )
+
+    async def acquire(self):
+        """rebalance the leases of this worker and return its chats."""
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                now = utc_now()
+                weight = ChatLease.backlog + 1
+
+                live_workers = await session.scalar(
+                    select(func.count()).select_from(Worker).where(
+                        Worker.heartbeat_at > now - self.lease_ttl,
+                        or_(Worker.flood_wait_until.is_(None), Worker.flood_wait_until < now)
+                    )
+                )
+                total = await session.scalar(select(func.coalesce(func.sum(weight), 0)))
+                share = math.ceil(total / max(live_workers, 1))
+
+                held = await session.execute(
+                    select(ChatLease.chat_id, weight)
+                    .where(ChatLease.worker == self.worker_id, ChatLease.lease_expires_at > now)
+                    .order_by(weight)
+                )
+                held = held.all()
+                held_weight = sum(chat_weight for _, chat_weight in held)
+
+                if held_weight < share:
+                    candidates = await session.execute(
+                        select(ChatLease.chat_id, weight)
+                        .where(or_(ChatLease.lease_expires_at.is_(None), ChatLease.lease_expires_at < now))
+                        .order_by((ChatLease.worker == self.worker_id).desc().nulls_last(), weight.desc())
+                        .limit(Config.LEASE_BATCH_SIZE)
+                        .with_for_update(skip_locked=True)
+                    )
+                    taken = []
+                    for chat_id, chat_weight in candidates:
+                        if held_weight >= share:
+                            break
+                        taken.append(chat_id)
+                        held_weight += chat_weight
+
+                    if taken:
+                        await session.execute(
+                            update(ChatLease)
+                            .where(ChatLease.chat_id.in_(taken))
+                            .values(worker=self.worker_id, lease_expires_at=now + self.lease_ttl)
+                        )
+                        logger.info(f"Worker {self.worker_id} leased {len(taken)} chats.")
+
+                elif held_weight > share * (1 + Config.REBALANCE_SLACK):
+                    # the largest chat is never released, it can't be split between workers
+                    released = []
+                    for chat_id, chat_weight in held[:-1]:
+                        if held_weight - chat_weight < share:
+                            break
+                        released.append(chat_id)
+                        held_weight -= chat_weight
+
+                    if released:
+                        await session.execute(
+                            update(ChatLease)
+                            .where(ChatLease.chat_id.in_(released))
+                            .values(worker=None, lease_expires_at=None)
+                        )
+                        logger.info(f"Worker {self.worker_id} released {len(released)} chats.")
+
+            result = await session.execute(
+                select(Chat)
+                .join(ChatLease, ChatLease.chat_id == Chat.id)
+                .where(ChatLease.worker == self.worker_id, ChatLease.lease_expires_at.is_not(None))
+            )
+            return result.scalars().all()
+
+    async def report(self, scraped):
+        """store the number of messages scraped per chat in the last sweep as its backlog."""
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                await session.execute(
+                    update(ChatLease)
+                    .where(ChatLease.worker == self.worker_id)
+                    .values(backlog=0)
+                )
+                if scraped:
+                    table = ChatLease.__table__
+                    await session.execute(
+                        update(table)
+                        .where(table.c.chat_id == bindparam("b_chat_id"), table.c.worker == self.worker_id)
+                        .values(backlog=bindparam("b_backlog")),
+                        [{"b_chat_id": chat_id, "b_backlog": count} for chat_id, count in scraped.items()]
+                    )
+
+    async def park(self, seconds):
+        """give up all chats while this worker waits out a flood wait."""
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                await session.execute(
+                    update(Worker)
+                    .where(Worker.id == self.worker_id)
+                    .values(flood_wait_until=utc_now() + timedelta(seconds=seconds))
+                )
+                await session.execute(
+                    update(ChatLease)
+                    .where(ChatLease.worker == self.worker_id)
+                    .values(worker=None, lease_expires_at=None)
+                )
+        logger.warning(f"Worker {self.worker_id} released its chats for {seconds:.0f} seconds of flood wait.")
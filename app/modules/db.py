@@ -1,11 +1,67 @@
+from uuid import uuid4
+
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from .config import Config
 
-async_engine = create_async_engine(Config.DATABASE_URL, echo=False)
+
+def _engine_options(database_url=None):
+    """
+    pool limits per worker, the fleet must stay under max_connections of postgres.
+    behind PgBouncer in transaction mode prepared statements can't be cached on
+    server connections, so both caches are disabled and statement names made unique.
+    """
+    url = make_url(database_url or Config.DATABASE_URL)
+    connect_args = {}
+
+    if Config.DB_PGBOUNCER:
+        url = url.update_query_dict({"prepared_statement_cache_size": "0"})
+        connect_args["statement_cache_size"] = 0
+        connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    else:
+        url = url.update_query_dict({"prepared_statement_cache_size": str(Config.DB_STATEMENT_CACHE_SIZE)})
+        connect_args["statement_cache_size"] = Config.DB_STATEMENT_CACHE_SIZE
+
+    return url, dict(
+        pool_size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_MAX_OVERFLOW,
+        pool_timeout=Config.DB_POOL_TIMEOUT,
+        pool_recycle=Config.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        connect_args=connect_args
+    )
+
+
+_url, _options = _engine_options()
+async_engine = create_async_engine(_url, echo=False, **_options)
 
 AsyncSessionLocal = sessionmaker(
     bind=async_engine,
     class_=AsyncSession,
     expire_on_commit=False
 )
+
+
+def _read_engine():
+    """
+    engine of the query API: read only sessions with a statement timeout, so an
+    expensive analyst query can't hold locks or run away next to the writers.
+    """
+    url, options = _engine_options(Config.READ_DATABASE_URL)
+    if not Config.DB_PGBOUNCER:
+        # PgBouncer rejects unknown startup parameters
+        options["connect_args"]["server_settings"] = {
+            "default_transaction_read_only": "on",
+            "statement_timeout": str(Config.QUERY_STATEMENT_TIMEOUT)
+        }
+    return create_async_engine(url, echo=False, **options)
+
+
+read_engine = _read_engine()
+
+ReadSessionLocal = sessionmaker(
+    bind=read_engine,
+    class_=AsyncSession,
+    expire_on_commit=False
+)
@@ -1,12 +1,13 @@
-from .minio_client import upload_file
+from .cache import known_users
 from .db import AsyncSessionLocal
-from .models import User, UserChat, Chat, UserHistory, Message
+from .models import Chat, MediaObject, Message, ScrapeState
+from sqlalchemy import text, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.future import select
 from .logging_setup import logger
-from sqlalchemy.orm import joinedload
-from datetime import datetime, timezone
+from datetime import datetime
+import hashlib
 import telethon
-import asyncio
 
 
 async def get_chats_for_worker(worker_id):
@@ -24,21 +25,18 @@ async def get_chats_for_worker(worker_id):
             return []
 
 
-async def get_last_message_id_for_chat(chat_id):
+async def get_scrape_states(chat_ids):
+    """resume points of all chats and forum topics of a worker, keyed by (chat_id, topic_id)."""
     async with AsyncSessionLocal() as session:
         try:
             result = await session.execute(
-                select(Message.message_id).where(Message.chat_id == chat_id).order_by(Message.timestamp.desc()).limit(1)
+                select(ScrapeState.chat_id, ScrapeState.topic_id, ScrapeState.last_message_id)
+                .where(ScrapeState.chat_id.in_(chat_ids))
             )
-            last_message_id = result.scalar()
-            if last_message_id:
-                logger.info(f"last message for chat {chat_id} have ID {last_message_id}.")
-            else:
-                logger.info(f"В чате {chat_id} нет сообщений в базе данных.")
-            return last_message_id
+            return {(chat_id, topic_id): last_message_id for chat_id, topic_id, last_message_id in result}
         except Exception as e:
-            logger.error(f"Ошибка при получении последнего сообщения для чата {chat_id}: {e}")
-            return None
+            logger.error(f"Ошибка при получении точек возобновления для чатов {chat_ids}: {e}")
+            return {}
 
 
 async def update_chat_data(chat_id):
@@ -52,222 +50,232 @@ async def update_chat_data(chat_id):
                 await session.commit()
 
 
-async def store_data_in_db(user_chat_map, chat_details_map):
+PROFILE_FIELDS = ("first_name", "last_name", "username", "deleted", "premium")
+
+# one statement per batch: all CTEs see the users table as it was before the
+# statement, so "old" still holds the previous values of the updated rows
+STORE_PROFILES = text("""
+WITH incoming AS (
+    SELECT * FROM unnest(
+        CAST(:ids AS BIGINT[]), CAST(:first_names AS TEXT[]), CAST(:last_names AS TEXT[]),
+        CAST(:usernames AS TEXT[]), CAST(:deleted AS BOOLEAN[]), CAST(:premium AS BOOLEAN[])
+    ) AS i(id, first_name, last_name, username, deleted, premium)
+),
+old AS (
+    SELECT u.id, u.first_name, u.last_name, u.username, u.deleted, u.premium
+    FROM users u JOIN incoming i ON i.id = u.id
+    WHERE (u.first_name, u.last_name, u.username, u.deleted, u.premium)
+          IS DISTINCT FROM (i.first_name, i.last_name, i.username, i.deleted, i.premium)
+),
+inserted AS (
+    INSERT INTO users (id, first_name, last_name, username, deleted, premium)
+    SELECT i.* FROM incoming i WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = i.id)
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id
+),
+updated AS (
+    UPDATE users u
+    SET first_name = i.first_name, last_name = i.last_name, username = i.username,
+        deleted = i.deleted, premium = i.premium
+    FROM incoming i JOIN old o ON o.id = i.id
+    WHERE u.id = i.id
+    RETURNING u.id
+),
+history AS (
+    INSERT INTO user_history (user_id, first_name, last_name, username, deleted, premium, timestamp)
+    SELECT o.id,
+           CASE WHEN o.first_name IS DISTINCT FROM i.first_name THEN o.first_name END,
+           CASE WHEN o.last_name IS DISTINCT FROM i.last_name THEN o.last_name END,
+           CASE WHEN o.username IS DISTINCT FROM i.username THEN o.username END,
+           CASE WHEN o.deleted IS DISTINCT FROM i.deleted THEN o.deleted END,
+           CASE WHEN o.premium IS DISTINCT FROM i.premium THEN o.premium END,
+           CAST(:now AS TIMESTAMP)
+    FROM old o JOIN incoming i ON i.id = o.id
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM updated), (SELECT count(*) FROM history)
+""")
+
+
+# order of the message tuples buffered by IngestionBuffer
+MESSAGE_COLUMNS = (
+    "chat_id", "message_id", "user_id", "message_text", "timestamp", "edit_date",
+    "reply_to_message_id", "forwarded_from_user_id"
+)
+
+# one array per column instead of one parameter set per message, returns the rows actually inserted
+INSERT_MESSAGES = text("""
+INSERT INTO messages (chat_id, message_id, user_id, message_text, timestamp, edit_date,
+                      reply_to_message_id, forwarded_from_user_id)
+SELECT * FROM unnest(
+    CAST(:chat_id AS BIGINT[]), CAST(:message_id AS BIGINT[]), CAST(:user_id AS BIGINT[]),
+    CAST(:message_text AS TEXT[]), CAST(:timestamp AS TIMESTAMP[]), CAST(:edit_date AS TIMESTAMP[]),
+    CAST(:reply_to_message_id AS BIGINT[]), CAST(:forwarded_from_user_id AS BIGINT[])
+)
+ON CONFLICT DO NOTHING
+RETURNING user_id, chat_id, timestamp
+""")
+
+
+def message_rows(messages):
+    """MESSAGE_COLUMNS tuples, spool segments written before the tuples still hold dicts."""
+    return [
+        tuple(message[column] for column in MESSAGE_COLUMNS) if isinstance(message, dict) else message
+        for message in messages
+    ]
+
+
+def message_params(messages):
+    """INSERT_MESSAGES parameters from MESSAGE_COLUMNS tuples, transposed in one pass."""
+    return {column: list(values) for column, values in zip(MESSAGE_COLUMNS, zip(*messages))}
+
+
+# summaries of the messages a batch actually inserted, the chat gets the users new to it
+UPDATE_ACTIVITY = text("""
+WITH batch AS (
+    SELECT * FROM unnest(
+        CAST(:user_ids AS BIGINT[]), CAST(:chat_ids AS BIGINT[]), CAST(:counts AS BIGINT[]),
+        CAST(:firsts AS TIMESTAMP[]), CAST(:lasts AS TIMESTAMP[])
+    ) AS b(user_id, chat_id, message_count, first_message_at, last_message_at)
+),
+upserted AS (
+    INSERT INTO user_chat_activity AS a (user_id, chat_id, message_count, first_message_at, last_message_at)
+    SELECT * FROM batch
+    ON CONFLICT (user_id, chat_id) DO UPDATE SET
+        message_count = a.message_count + excluded.message_count,
+        first_message_at = least(a.first_message_at, excluded.first_message_at),
+        last_message_at = greatest(a.last_message_at, excluded.last_message_at)
+    RETURNING a.chat_id, (xmax = 0) AS is_new
+),
+new_users AS (
+    SELECT chat_id, count(*) AS user_count FROM upserted WHERE is_new GROUP BY chat_id
+)
+INSERT INTO chat_activity AS c (chat_id, message_count, user_count, first_message_at, last_message_at)
+SELECT b.chat_id, sum(b.message_count), coalesce(max(n.user_count), 0), min(b.first_message_at), max(b.last_message_at)
+FROM batch b LEFT JOIN new_users n ON n.chat_id = b.chat_id
+GROUP BY b.chat_id
+ON CONFLICT (chat_id) DO UPDATE SET
+    message_count = c.message_count + excluded.message_count,
+    user_count = c.user_count + excluded.user_count,
+    first_message_at = least(c.first_message_at, excluded.first_message_at),
+    last_message_at = greatest(c.last_message_at, excluded.last_message_at)
+""")
+
+
+def activity_params(rows):
+    """UPDATE_ACTIVITY parameters from (user_id, chat_id, timestamp) rows of inserted messages."""
+    activity = {}
+    for user_id, chat_id, timestamp in rows:
+        key = (user_id, chat_id)
+        count, first, last = activity.get(key, (0, timestamp, timestamp))
+        activity[key] = (count + 1, min(first, timestamp), max(last, timestamp))
+
+    keys = sorted(activity)
+    return {
+        "user_ids": [user_id for user_id, _ in keys],
+        "chat_ids": [chat_id for _, chat_id in keys],
+        "counts": [activity[key][0] for key in keys],
+        "firsts": [activity[key][1] for key in keys],
+        "lasts": [activity[key][2] for key in keys]
+    }
+
+
+async def store_user_profiles(profiles):
+    """
+    inserts new users, updates users whose profile changed and saves the previous
+    values to user_history with a single statement. profiles maps user id to a users row.
+    """
+    rows = [profiles[user_id] for user_id in sorted(profiles)]
+    params = {
+        "ids": [row["id"] for row in rows],
+        "first_names": [row["first_name"] for row in rows],
+        "last_names": [row["last_name"] for row in rows],
+        "usernames": [row["username"] for row in rows],
+        "deleted": [row["deleted"] for row in rows],
+        "premium": [row["premium"] for row in rows],
+        "now": datetime.utcnow()
+    }
+
     async with AsyncSessionLocal() as session:
-        async with session.begin():
-            for user_id, chats in user_chat_map.items():
-                result = await session.execute(select(User).where(User.id == user_id))
-                user = result.scalar()
-
-                if not user:
-                    user = User(id=user_id)
-                    session.add(user)
-
-                for chat in chats:
-                    result = await session.execute(select(Chat).where(Chat.id == chat.id))
-                    db_chat = result.scalar()
-                    if not db_chat:
-                        chat_details = chat_details_map.get(chat.id)
-                        if chat_details:
-                            db_chat = Chat(
-                                id=chat_details["id"],
-                                title=chat_details["title"],
-                                invite_link_id=chat_details["invite_link"]
-                            )
-                            session.add(db_chat)
-
-                    result = await session.execute(
-                        select(UserChat).where(UserChat.user_id == user_id, UserChat.chat_id == chat.id)
-                    )
-                    user_chat = result.scalar()
-                    if not user_chat:
-                        user_chat = UserChat(user_id=user_id, chat_id=chat.id)
-                        session.add(user_chat)
+        try:
+            async with session.begin():
+                result = await session.execute(STORE_PROFILES, params)
+                new_users, changed_users, _ = result.one()
 
-            await session.commit()
+            known_users.update(params["ids"])
+            logger.info(f"Stored {len(profiles)} profiles: {new_users} new, {changed_users} changed.")
+            return True
+        except Exception as e:
+            logger.error(f"Error storing {len(profiles)} user profiles: {e}")
+            return False
 
 
-async def update_user_data(user_id, first_name, last_name, username, deleted, premium):
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            result = await session.execute(select(User).where(User.id == user_id).options(joinedload(User.history)))
-            user = result.scalar()
-
-            if not user:
-                user = User(id=user_id, first_name=first_name, last_name=last_name,
-                            username=username, deleted=deleted, premium=premium)
-                session.add(user)
-            else:
-                new_history = UserHistory(user_id=user_id)
-
-                data_changed = False
-
-                if user.first_name != first_name:
-                    new_history.first_name = user.first_name
-                    user.first_name = first_name
-                    data_changed = True
-
-                if user.last_name != last_name:
-                    new_history.last_name = user.last_name
-                    user.last_name = last_name
-                    data_changed = True
-
-                if user.username != username:
-                    new_history.username = user.username
-                    user.username = username
-                    data_changed = True
-
-                if user.deleted != deleted:
-                    new_history.deleted = user.deleted
-                    user.deleted = deleted
-                    data_changed = True
-
-                if user.premium != premium:
-                    new_history.premium = user.premium
-                    user.premium = premium
-                    data_changed = True
-
-                if data_changed:
-                    new_history.timestamp = datetime.utcnow()
-                    session.add(new_history)
-
-            await session.commit()
+def text_hash(text):
+    """same value as the generated messages.text_hash column: first 64 bits of md5 as a signed integer."""
+    return int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "big", signed=True)
 
 
-async def store_message_in_db(
-        user_id, chat_id, message_id, message_text, timestamp, chat_title=None, user_data=None,
-        reply_to_message_id=None, forwarded_from_user_id=None, forwarded_from_user_data=None, media=None, client=None
-):
-    """save only voice messages and circles to the database."""
+async def get_message_fingerprints(chat_id, limit):
+    """{message_id: (text_hash, edit_date)} of the latest limit messages of a chat that are not marked deleted."""
     async with AsyncSessionLocal() as session:
         try:
-            async with session.begin():
-                if not message_text:
-                    message_text = "[no text in message]"
-
-                if timestamp.tzinfo is not None:
-                    naive_timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
-                else:
-                    naive_timestamp = timestamp
-
-                result = await session.execute(select(User).where(User.id == user_id))
-                user = result.scalar()
-
-                if not user:
-                    username = user_data.get("username") if user_data else None
-                    first_name = user_data.get("first_name") if user_data else None
-                    last_name = user_data.get("last_name") if user_data else None
-                    new_user = User(
-                        id=user_id,
-                        username=username,
-                        first_name=first_name,
-                        last_name=last_name,
-                        deleted=user_data.get("deleted", False) if user_data else False,
-                        premium=user_data.get("premium", False) if user_data else False
-                    )
-                    session.add(new_user)
-                    logger.info(f"Пользователь {user_id} добавлен в базу данных.")
-
-                if forwarded_from_user_id:
-                    result = await session.execute(select(User).where(User.id == forwarded_from_user_id))
-                    forwarded_user = result.scalar()
-
-                    if not forwarded_user:
-                        forwarded_username = forwarded_from_user_data.get(
-                            "username") if forwarded_from_user_data else None
-                        forwarded_first_name = forwarded_from_user_data.get(
-                            "first_name") if forwarded_from_user_data else None
-                        forwarded_last_name = forwarded_from_user_data.get(
-                            "last_name") if forwarded_from_user_data else None
-                        new_forwarded_user = User(
-                            id=forwarded_from_user_id,
-                            username=forwarded_username,
-                            first_name=forwarded_first_name,
-                            last_name=forwarded_last_name,
-                            deleted=forwarded_from_user_data.get("deleted",
-                                                                 False) if forwarded_from_user_data else False,
-                            premium=forwarded_from_user_data.get("premium",
-                                                                 False) if forwarded_from_user_data else False
-                        )
-                        session.add(new_forwarded_user)
-
-                result = await session.execute(select(Chat).where(Chat.id == chat_id))
-                chat = result.scalar()
-
-                if not chat:
-                    if not chat_title:
-                        chat_title = "[no title]"
-                    new_chat = Chat(id=chat_id, title=chat_title)
-                    session.add(new_chat)
-
-                message_type = "text"
-                file_url = None
-
-                if media:
-                    if isinstance(media, telethon.tl.types.MessageMediaDocument):
-                        file_extension = None
-
-                        for attribute in media.document.attributes:
-                            if isinstance(attribute, telethon.tl.types.DocumentAttributeAudio) and attribute.voice:
-                                message_type = "voice"
-                                file_extension = 'ogg'
-                                break
-                            elif isinstance(attribute,
-                                            telethon.tl.types.DocumentAttributeVideo) and attribute.round_message:
-                                message_type = "round_video"
-                                file_extension = 'mp4'
-                                break
-
-                        if message_type in ["voice", "round_video"]:
-                            await asyncio.create_task(
-                                download_and_store_media(client, media, chat_id, message_id, file_extension))
-                        else:
-                            return
-
-                    else:
-                        return
-
-                new_message = Message(
-                    user_id=user_id,
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    message_text=message_text,
-                    timestamp=naive_timestamp,
-                    file_url=file_url,
-                    reply_to_message_id=reply_to_message_id,
-                    forwarded_from_user_id=forwarded_from_user_id
-                )
-                session.add(new_message)
+            result = await session.execute(
+                select(Message.message_id, Message.text_hash, Message.edit_date)
+                .where(Message.chat_id == chat_id, Message.deleted.is_(False))
+                .order_by(Message.message_id.desc())
+                .limit(limit)
+            )
+            return {message_id: (hash_value, edit_date) for message_id, hash_value, edit_date in result}
+        except Exception as e:
+            logger.error(f"Error loading message fingerprints of chat {chat_id}: {e}")
+            return {}
 
-            await session.commit()
 
-        except Exception as e:
-            await session.rollback()
-            logger.error(f"Error inserting message: {e}")
+def get_media_type(media):
+    """returns (message_type, file_extension) for voice messages and circles, None for other media."""
+    if isinstance(media, telethon.tl.types.MessageMediaDocument):
+        for attribute in media.document.attributes:
+            if isinstance(attribute, telethon.tl.types.DocumentAttributeAudio) and attribute.voice:
+                return "voice", 'ogg'
+            elif isinstance(attribute, telethon.tl.types.DocumentAttributeVideo) and attribute.round_message:
+                return "round_video", 'mp4'
+    return None
 
 
-async def download_and_store_media(client, media, chat_id, message_id, extension):
-    try:
-        file_path = await client.download_media(media)
-        file_url = upload_file(file_path, f"{chat_id}/{message_id}.{extension}")
-        await update_message_with_file_url(message_id, file_url)
-    except Exception as e:
-        logger.error(f"Error loading media file for message {message_id}: {e}")
+async def find_media_object(document_id=None, sha256=None):
+    """file_url of a stored media object by telegram document id or content hash, None if there is none."""
+    condition = MediaObject.document_id == document_id if sha256 is None else MediaObject.sha256 == sha256
+    async with AsyncSessionLocal() as session:
+        try:
+            result = await session.execute(select(MediaObject.file_url).where(condition).limit(1))
+            return result.scalar()
+        except Exception as e:
+            logger.error(f"Error looking up media object {document_id or sha256}: {e}")
+            return None
 
 
-async def update_message_with_file_url(message_id, file_url):
+async def store_media_object(document_id, sha256, file_url, size):
     async with AsyncSessionLocal() as session:
         try:
             async with session.begin():
-                result = await session.execute(select(Message).where(Message.message_id == message_id))
-                message = result.scalar()
+                await session.execute(
+                    insert(MediaObject.__table__)
+                    .values(document_id=document_id, sha256=sha256, file_url=file_url, size=size)
+                    .on_conflict_do_nothing(index_elements=["document_id"])
+                )
+        except Exception as e:
+            logger.error(f"Error storing media object for document {document_id}: {e}")
 
-                if message:
-                    message.file_url = file_url
-                    session.add(message)
 
-            await session.commit()
+async def update_message_with_file_url(chat_id, message_id, file_url):
+    async with AsyncSessionLocal() as session:
+        try:
+            async with session.begin():
+                await session.execute(
+                    update(Message)
+                    .where(Message.chat_id == chat_id, Message.message_id == message_id)
+                    .values(file_url=file_url)
+                )
 
         except Exception as e:
-            await session.rollback()
             logger.error(f"Error updating file link for message {message_id}: {e}")
@@ -0,0 +1,95 @@
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+from telethon import events
+
+from .db import AsyncSessionLocal
+from .governor import governor
+from .logging_setup import logger
+from .models import WorkerDialog
+
+
+class DialogIndex:
+    """
+    Ids of the dialogs the worker account is a member of.
+
+    Loaded from worker_dialogs once per run, the dialog list is only fetched when
+    nothing is stored for the worker yet. Joins and leaves of the account are
+    applied from ChatAction updates and written through to the table.
+    """
+
+    def __init__(self):
+        self.worker_id = None
+        self._chat_ids = set()
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chat_ids
+
+    async def load(self, client, worker_id):
+        if self.worker_id == worker_id:
+            return
+        self.worker_id = worker_id
+
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(WorkerDialog.chat_id).where(WorkerDialog.worker == worker_id)
+            )
+            self._chat_ids = set(result.scalars())
+
+        if not self._chat_ids:
+            await self.refresh(client)
+
+        client.add_event_handler(self._on_chat_action, events.ChatAction())
+        logger.info(f"Dialog index loaded with {len(self._chat_ids)} chats.")
+
+    async def refresh(self, client):
+        """rebuild the index from the full dialog list of the account."""
+        dialogs = await governor.collect("iter_dialogs", client.iter_dialogs)
+        self._chat_ids = {dialog.id for dialog in dialogs}
+
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                await session.execute(delete(WorkerDialog).where(WorkerDialog.worker == self.worker_id))
+                if self._chat_ids:
+                    await session.execute(
+                        insert(WorkerDialog.__table__).on_conflict_do_nothing(),
+                        [{"worker": self.worker_id, "chat_id": chat_id} for chat_id in self._chat_ids]
+                    )
+
+    async def add(self, chat_id):
+        if chat_id in self._chat_ids:
+            return
+        self._chat_ids.add(chat_id)
+        await self._store(
+            insert(WorkerDialog.__table__).values(worker=self.worker_id, chat_id=chat_id).on_conflict_do_nothing()
+        )
+
+    async def discard(self, chat_id):
+        if chat_id not in self._chat_ids:
+            return
+        self._chat_ids.discard(chat_id)
+        await self._store(
+            delete(WorkerDialog).where(WorkerDialog.worker == self.worker_id, WorkerDialog.chat_id == chat_id)
+        )
+
+    async def _store(self, stmt):
+        if self.worker_id is None:
+            return
+        async with AsyncSessionLocal() as session:
+            try:
+                await session.execute(stmt)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                logger.error(f"Error updating dialog index of worker {self.worker_id}: {e}")
+
+    async def _on_chat_action(self, event):
+        if event.user_id != self.worker_id:
+            return
+        if event.user_joined or event.user_added:
+            await self.add(event.chat_id)
+        elif event.user_left or event.user_kicked:
+            await self.discard(event.chat_id)
+
+
+dialog_index = DialogIndex()
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from collections import defaultdict
+
+from telethon.errors import FloodWaitError
+
+from .config import Config
+from .logging_setup import logger
+from .metrics import FLOOD_WAIT_SECONDS
+from .scheduler import rate_limiter
+
+
+class ChatParked(Exception):
+    """the request can't be made for a while, the chat should give up its scheduler slot."""
+
+    def __init__(self, seconds):
+        super().__init__(f"parked for {seconds:.0f} seconds")
+        self.seconds = seconds
+
+
+class MethodBudget:
+    """
+    Pacing of one telegram method, AIMD style: the rate grows by GOVERNOR_RATE_STEP
+    after every successful call and is multiplied by GOVERNOR_BACKOFF after a flood wait.
+    """
+
+    def __init__(self):
+        self.rate = Config.GOVERNOR_MAX_RATE
+        self.blocked_until = 0
+        self._next_call = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                remaining = self.blocked_until - now
+                if remaining > Config.GOVERNOR_MAX_INLINE_WAIT:
+                    raise ChatParked(remaining)
+                await asyncio.sleep(remaining)
+                now = time.monotonic()
+
+            if self._next_call > now:
+                await asyncio.sleep(self._next_call - now)
+                now = self._next_call
+            self._next_call = now + 1 / self.rate
+
+    def on_success(self):
+        self.rate = min(Config.GOVERNOR_MAX_RATE, self.rate + Config.GOVERNOR_RATE_STEP)
+
+    def on_flood(self, seconds):
+        self.rate = max(Config.GOVERNOR_MIN_RATE, self.rate * Config.GOVERNOR_BACKOFF)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RequestGovernor:
+    """
+    Single entry point for telegram requests.
+
+    Calls go through the global token bucket and the pacing of their method. A
+    FloodWaitError blocks only that method: short waits are slept through and the
+    call retried, longer ones raise ChatParked so the calling chat is parked by
+    the scheduler while other chats keep using other methods.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._budgets = defaultdict(MethodBudget)
+
+    async def call(self, method, request):
+        """request is a zero-argument callable returning the awaitable to run."""
+        budget = self._budgets[method]
+        while True:
+            await budget.wait()
+            await self.bucket.acquire()
+            try:
+                result = await request()
+            except FloodWaitError as e:
+                FLOOD_WAIT_SECONDS.inc(e.seconds)
+                budget.on_flood(e.seconds)
+                logger.warning(f"Flood wait of {e.seconds} seconds on {method}, rate lowered to {budget.rate:.2f}/s.")
+                continue
+            budget.on_success()
+            return result
+
+    async def collect(self, method, iterator_factory):
+        """run an async iterator such as iter_messages to completion as one governed call."""
+        async def request():
+            return [item async for item in iterator_factory()]
+
+        return await self.call(method, request)
+
+
+governor = RequestGovernor(rate_limiter)
@@ -0,0 +1,432 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import timezone
+
+from sqlalchemy import bindparam, func, or_, update
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .backfill import lease_expiry
+from .cache import known_users, known_chats, known_user_chats
+from .config import Config
+from .db import async_engine
+from .db_operations import INSERT_MESSAGES, UPDATE_ACTIVITY, activity_params, get_media_type, get_scrape_states, \
+    message_params, message_rows
+from .logging_setup import logger
+from .media import MediaPipeline
+from .metrics import DB_FLUSH_SECONDS, DB_FLUSH_ROWS, DB_FLUSH_ERRORS, MESSAGES_INGESTED
+from .profiles import ProfileResolver, build_user_row
+from .models import User, Chat, UserChat, Message, ScrapeState, BackfillRange
+from .spool import Spool
+
+
+class BatchRejected(Exception):
+    """the database refused the data of a batch, writing it again would fail the same way."""
+
+
+def rejected_by_database(error):
+    """data exceptions and constraint violations, SQLSTATE classes 22 and 23."""
+    if isinstance(error, (IntegrityError, DataError)):
+        return True
+    sqlstate = getattr(getattr(error, "orig", None), "sqlstate", None) or ""
+    return sqlstate[:2] in ("22", "23")
+
+
+def naive_utc(value):
+    """telethon dates are aware, the tables store naive UTC timestamps."""
+    if value is None or value.tzinfo is None:
+        return value
+    if value.tzinfo is timezone.utc:
+        return value.replace(tzinfo=None)
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class IngestionBuffer:
+    """
+    Accumulates messages, senders and chats scraped with iter_messages and
+    writes them in one transaction with multi-row INSERT ... ON CONFLICT DO NOTHING.
+
+    Flush happens when flush_size messages are buffered, every flush_interval
+    seconds while the buffer is started, and on close(). Senders seen on the
+    way are handed to the profile resolver, voice messages and circles are
+    queued to the media pipeline once their rows are committed.
+
+    With SPOOL_ENABLED a flush only writes the batch to the local spool, a
+    writer task commits spooled batches in order and retries them until the
+    database takes them, so a database outage neither loses rows nor stalls
+    scraping. Batches left in the spool by a crash are replayed on start.
+
+    The last message id of every (chat, topic) is written to scrape_state in
+    the same transaction as the batch, checkpoints holds the committed values.
+    Users are linked to their chats in user_chat as (user_id, chat_id) pairs,
+    so membership is durable as soon as the batch is flushed. Progress of
+    backfill ranges is committed with the batch the same way.
+    """
+
+    def __init__(self, client, flush_size=None, flush_interval=None):
+        self.client = client
+        self.profiles = ProfileResolver(client)
+        self.media = MediaPipeline(client)
+        self.flush_size = flush_size or Config.INGEST_FLUSH_SIZE
+        self.flush_interval = flush_interval or Config.INGEST_FLUSH_INTERVAL
+        self.spool = Spool(Config.SPOOL_DIR, Config.SPOOL_MAX_SEGMENTS) if Config.SPOOL_ENABLED else None
+
+        self._users = {}
+        self._chats = {}
+        self._messages = []
+        self._media_jobs = []
+        self._pending_checkpoints = {}
+        self._edits = {}
+        self._deletions = set()
+        self._memberships = set()
+        self._range_progress = {}
+
+        self.checkpoints = {}
+        self.scraped = Counter()
+
+        self._lock = asyncio.Lock()
+        self._closing = asyncio.Event()
+        self._flush_task = None
+        self._writer_task = None
+        self._connection = None
+        self._session = None
+
+    def start(self):
+        self.media.start()
+        if self._flush_task is None:
+            self._closing.clear()
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+        if self.spool is not None and self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._drain_spool())
+
+    async def close(self):
+        if self._flush_task is not None:
+            # not cancelled: a flush that has taken the buffers must finish writing them
+            self._closing.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        if self._writer_task is not None:
+            try:
+                await asyncio.wait_for(self.spool.drained(), Config.SPOOL_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"{len(self.spool)} spooled batches are left for the next start.")
+            self._writer_task.cancel()
+            await asyncio.gather(self._writer_task, return_exceptions=True)
+            self._writer_task = None
+        await self.profiles.flush()
+        await self.media.close()
+        await self._reset_session()
+
+    async def _get_session(self):
+        """the writer keeps one connection for all flushes, so its prepared statements stay cached."""
+        if self._session is None:
+            self._connection = await async_engine.connect()
+            self._session = AsyncSession(bind=self._connection, expire_on_commit=False)
+        return self._session
+
+    async def _reset_session(self):
+        if self._session is not None:
+            try:
+                await self._session.close()
+                await self._connection.close()
+            except Exception as e:
+                logger.warning(f"Error closing ingestion connection: {e}")
+            self._session = None
+            self._connection = None
+
+    async def load_checkpoints(self, chat_ids):
+        self.checkpoints.update(await get_scrape_states(chat_ids))
+
+    async def _flush_periodically(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def add_message(self, message, chat, topic_id=0, checkpoint=True):
+        """
+        buffer a telethon message, only text messages, voice messages and circles are stored.
+        live updates pass checkpoint=False, so a gap before them is still picked up by the next sweep.
+        every telethon property is read once, the message is kept as a MESSAGE_COLUMNS tuple.
+        """
+        chat_id = chat.id
+        message_id = message.id
+        if checkpoint:
+            self.scraped[chat_id] += 1
+            key = (chat_id, topic_id)
+            if message_id > self._pending_checkpoints.get(key, 0):
+                self._pending_checkpoints[key] = message_id
+
+        sender_id = message.sender_id
+        if not sender_id:
+            return
+
+        sender = message.sender
+        if sender is not None:
+            self.profiles.observe(sender)
+        else:
+            self.profiles.request(sender_id)
+
+        users = self._users
+        if sender_id not in users and sender_id not in known_users:
+            users[sender_id] = build_user_row(sender_id, sender)
+
+        if chat_id not in self._chats and chat_id not in known_chats:
+            self._chats[chat_id] = {"id": chat_id, "title": chat.title or "[no title]"}
+
+        # positive ids are users, channels posting to the chat are not members
+        if sender_id > 0:
+            membership = (sender_id, chat_id)
+            if membership not in self._memberships and membership not in known_user_chats:
+                self._memberships.add(membership)
+
+        media = message.media
+        file_extension = None
+        if media is not None:
+            media_type = get_media_type(media)
+            if media_type is None:
+                return
+            file_extension = media_type[1]
+
+        forward = message.forward
+        forwarded_from_user_id = None
+        if forward is not None:
+            forwarded_from_user_id = forward.sender_id
+            if forwarded_from_user_id and forwarded_from_user_id not in users \
+                    and forwarded_from_user_id not in known_users:
+                users[forwarded_from_user_id] = build_user_row(forwarded_from_user_id, forward.sender)
+
+        self._messages.append((
+            chat_id,
+            message_id,
+            sender_id,
+            message.message or "[no text in message]",
+            naive_utc(message.date),
+            naive_utc(message.edit_date),
+            message.reply_to_msg_id,
+            forwarded_from_user_id
+        ))
+
+        if file_extension:
+            self._media_jobs.append((media, chat_id, message_id, file_extension))
+
+        if len(self._messages) >= self.flush_size:
+            await self.flush()
+
+    def add_range_progress(self, chat_id, start_id, last_message_id, done=False):
+        """backfill range progress, written with the batch holding the messages added before it."""
+        self._range_progress[(chat_id, start_id)] = {
+            "b_chat_id": chat_id,
+            "b_start_id": start_id,
+            "b_last_message_id": last_message_id,
+            "b_done": done
+        }
+
+    async def add_edit(self, message, chat):
+        """buffer new text of an edited message, applied after the inserts of the same flush."""
+        if message.media and get_media_type(message.media) is None:
+            return
+
+        self._edits[(chat.id, message.id)] = {
+            "b_chat_id": chat.id,
+            "b_message_id": message.id,
+            "b_message_text": message.message or "[no text in message]",
+            "b_edit_date": naive_utc(message.edit_date)
+        }
+
+        if len(self._messages) + len(self._edits) >= self.flush_size:
+            await self.flush()
+
+    def add_deletions(self, chat_id, message_ids):
+        """mark messages deleted in telegram, the rows are kept."""
+        self._deletions.update((chat_id, message_id) for message_id in message_ids)
+
+    async def flush(self):
+        # downloads that fell behind slow scraping down, the spool writer never waits for them
+        await self.media.wait_for_room()
+        async with self._lock:
+            if not self._messages and not self._pending_checkpoints and not self._edits and not self._memberships \
+                    and not self._range_progress and not self._deletions:
+                return
+
+            batch = {
+                "users": list(self._users.values()),
+                "chats": list(self._chats.values()),
+                "memberships": self._memberships,
+                "messages": self._messages,
+                "edits": list(self._edits.values()),
+                "deletions": self._deletions,
+                "checkpoints": self._pending_checkpoints,
+                "ranges": list(self._range_progress.values()),
+                "media_jobs": self._media_jobs
+            }
+
+            self._users = {}
+            self._chats = {}
+            self._messages = []
+            self._media_jobs = []
+            self._pending_checkpoints = {}
+            self._edits = {}
+            self._deletions = set()
+            self._memberships = set()
+            self._range_progress = {}
+
+            if self.spool is not None:
+                await self.spool.append(batch)
+                return
+
+            try:
+                committed = await self._write_batch(batch)
+            except BatchRejected as e:
+                logger.error(f"Batch of {len(batch['messages'])} messages rejected by the database, dropped: {e}")
+                committed = False
+
+        if committed:
+            self._submit_media(batch)
+
+    async def _drain_spool(self):
+        """
+        write spooled batches in order, a failed batch is retried with backoff instead of dropped.
+        a batch the database rejects for its data would fail the same way forever, it is moved aside.
+        """
+        delay = 1
+        while True:
+            path, batch = await self.spool.next()
+            try:
+                written = await self._write_batch(batch)
+            except BatchRejected as e:
+                logger.error(f"Spooled batch {path} rejected by the database, moved aside: {e}")
+                await self.spool.reject(path)
+                delay = 1
+                continue
+
+            if written:
+                await self.spool.ack(path)
+                self._submit_media(batch)
+                delay = 1
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def _write_batch(self, batch):
+        """
+        write one batch in a single transaction, returns False when it failed and can be retried.
+        raises BatchRejected when the database refuses its data, the same batch would be rejected again.
+        """
+        users = batch["users"]
+        chats = batch["chats"]
+        memberships = batch["memberships"]
+        messages = message_rows(batch["messages"])
+        edits = batch["edits"]
+        deletions = batch.get("deletions", set())
+        checkpoints = batch["checkpoints"]
+        ranges = batch.get("ranges", [])
+
+        started = time.perf_counter()
+        try:
+            session = await self._get_session()
+            async with session.begin():
+                if users:
+                    await session.execute(
+                        insert(User.__table__).on_conflict_do_nothing(index_elements=["id"]), users
+                    )
+                if chats:
+                    await session.execute(
+                        insert(Chat.__table__).on_conflict_do_nothing(index_elements=["id"]), chats
+                    )
+                if memberships:
+                    await session.execute(
+                        insert(UserChat.__table__).on_conflict_do_nothing(),
+                        [{"user_id": user_id, "chat_id": chat_id} for user_id, chat_id in memberships]
+                    )
+                if messages:
+                    inserted = await session.execute(INSERT_MESSAGES, message_params(messages))
+                    # only new rows are counted, so replayed batches leave the summaries alone
+                    inserted = inserted.all()
+                    if inserted:
+                        await session.execute(UPDATE_ACTIVITY, activity_params(inserted))
+                if edits:
+                    table = Message.__table__
+                    await session.execute(
+                        update(table)
+                        .where(table.c.chat_id == bindparam("b_chat_id"),
+                               table.c.message_id == bindparam("b_message_id"))
+                        .values(message_text=bindparam("b_message_text"), edit_date=bindparam("b_edit_date")),
+                        edits
+                    )
+                if deletions:
+                    table = Message.__table__
+                    await session.execute(
+                        update(table)
+                        .where(table.c.chat_id == bindparam("b_chat_id"),
+                               table.c.message_id == bindparam("b_message_id"))
+                        .values(deleted=True),
+                        [{"b_chat_id": chat_id, "b_message_id": message_id} for chat_id, message_id in deletions]
+                    )
+                if ranges:
+                    table = BackfillRange.__table__
+                    await session.execute(
+                        update(table)
+                        .where(table.c.chat_id == bindparam("b_chat_id"),
+                               table.c.start_id == bindparam("b_start_id"))
+                        .values(
+                            last_message_id=func.greatest(table.c.last_message_id, bindparam("b_last_message_id")),
+                            done=or_(table.c.done, bindparam("b_done")),
+                            lease_expires_at=lease_expiry()
+                        ),
+                        ranges
+                    )
+                await self._store_checkpoints(session, checkpoints)
+        except Exception as e:
+            DB_FLUSH_ERRORS.inc()
+            if rejected_by_database(e):
+                await self._reset_session()
+                raise BatchRejected(str(e)) from e
+            logger.error(f"Error flushing {len(messages)} messages: {e}")
+            await self._reset_session()
+            return False
+
+        DB_FLUSH_SECONDS.observe(time.perf_counter() - started)
+        DB_FLUSH_ROWS.observe(len(messages))
+        for chat_id, count in Counter(message[0] for message in messages).items():
+            MESSAGES_INGESTED.labels(chat_id=chat_id).inc(count)
+
+        for key, last_message_id in checkpoints.items():
+            if last_message_id > self.checkpoints.get(key, 0):
+                self.checkpoints[key] = last_message_id
+        known_users.update(user["id"] for user in users)
+        known_chats.update(chat["id"] for chat in chats)
+        known_user_chats.update(memberships)
+
+        logger.info(
+            f"Flushed {len(messages)} messages, {len(edits)} edits, {len(deletions)} deletions, {len(users)} users, {len(chats)} chats, "
+            f"{len(memberships)} memberships."
+        )
+        return True
+
+    def _submit_media(self, batch):
+        for media, chat_id, message_id, extension in batch["media_jobs"]:
+            self.media.submit(media, chat_id, message_id, extension)
+
+    @staticmethod
+    async def _store_checkpoints(session, checkpoints):
+        if not checkpoints:
+            return
+
+        table = ScrapeState.__table__
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["chat_id", "topic_id"],
+            set_={
+                "last_message_id": func.greatest(table.c.last_message_id, stmt.excluded.last_message_id),
+                "updated_at": func.now()
+            }
+        )
+        await session.execute(stmt, [
+            {"chat_id": chat_id, "topic_id": topic_id, "last_message_id": last_message_id}
+            for (chat_id, topic_id), last_message_id in checkpoints.items()
+        ])
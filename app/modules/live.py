@@ -0,0 +1,93 @@
+import asyncio
+
+from telethon import events
+
+from .cache import warm_cache
+from .config import Config
+from .db_operations import get_chats_for_worker
+from .dialogs import dialog_index
+from .ingestion import IngestionBuffer
+from .logging_setup import logger
+from .scheduler import SweepParked
+from .telegram_client import sweep_chats
+
+
+def get_topic_id(message):
+    """id of the forum topic a message belongs to, 0 outside of forums."""
+    reply_to = message.reply_to
+    if reply_to is None or not getattr(reply_to, "forum_topic", False):
+        return 0
+    return reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+
+
+async def run_daemon(client, worker_id, batch_size=500, coordinator=None):
+    """
+    Catch up on all chats of the worker, then keep them fresh from NewMessage,
+    MessageEdited and MessageDeleted updates. A sweep from the stored checkpoints is repeated every
+    DAEMON_BACKFILL_INTERVAL seconds to fill gaps left by missed updates.
+    With a coordinator the leased chats are rebalanced before every sweep.
+    """
+    chats = await get_chats_for_worker(worker_id) if coordinator is None else []
+    chats_by_id = {chat.id: chat for chat in chats}
+    await warm_cache(list(chats_by_id))
+    await dialog_index.load(client, worker_id)
+
+    buffer = IngestionBuffer(client)
+    await buffer.load_checkpoints(list(chats_by_id))
+    buffer.start()
+
+    async def on_new_message(event):
+        chat = chats_by_id.get(event.chat_id)
+        if chat:
+            await buffer.add_message(event.message, chat, get_topic_id(event.message), checkpoint=False)
+
+    async def on_message_edited(event):
+        chat = chats_by_id.get(event.chat_id)
+        if chat:
+            await buffer.add_edit(event.message, chat)
+
+    async def on_message_deleted(event):
+        # telegram only says which chat a deletion belongs to for channels and supergroups
+        if event.chat_id in chats_by_id:
+            buffer.add_deletions(event.chat_id, event.deleted_ids)
+
+    # chats are filtered in the handlers, the leased set can change between sweeps
+    client.add_event_handler(on_new_message, events.NewMessage())
+    client.add_event_handler(on_message_edited, events.MessageEdited())
+    client.add_event_handler(on_message_deleted, events.MessageDeleted())
+
+    chat_details_map = {}
+    try:
+        while True:
+            try:
+                if coordinator:
+                    chats = await coordinator.acquire()
+                    new_chat_ids = [chat.id for chat in chats if chat.id not in chats_by_id]
+                    chats_by_id.clear()
+                    chats_by_id.update((chat.id, chat) for chat in chats)
+                    await warm_cache(new_chat_ids)
+                    # chats may have been scraped by other workers while leased to them
+                    await buffer.load_checkpoints(list(chats_by_id))
+
+                await sweep_chats(client, worker_id, chats, buffer, batch_size, chat_details_map, coordinator)
+                await buffer.flush()
+
+                if coordinator:
+                    await coordinator.report(buffer.scraped)
+                buffer.scraped.clear()
+            except SweepParked as e:
+                # the flood wait is already counted by the request governor
+                logger.warning(f"Request limit exceeded, waiting {e.seconds:.0f} seconds...")
+                await coordinator.park(e.seconds)
+                await asyncio.sleep(e.seconds)
+                continue
+            except Exception as e:
+                logger.error(f"Error during backfill sweep: {e}")
+
+            logger.info(f"Backfill sweep finished, next one in {Config.DAEMON_BACKFILL_INTERVAL} seconds.")
+            await asyncio.sleep(Config.DAEMON_BACKFILL_INTERVAL)
+    finally:
+        client.remove_event_handler(on_new_message)
+        client.remove_event_handler(on_message_edited)
+        client.remove_event_handler(on_message_deleted)
+        await buffer.close()
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import tempfile
+import time
+
+from .cache import LRUDict
+from .config import Config
+from .db_operations import find_media_object, store_media_object, update_message_with_file_url
+from .governor import ChatParked, governor
+from .logging_setup import logger
+from .metrics import MEDIA_DEDUPLICATED, MEDIA_QUEUE_DEPTH, MEDIA_UPLOAD_SECONDS
+from .minio_client import upload_stream
+
+CONTENT_TYPES = {
+    "ogg": "audio/ogg",
+    "mp4": "video/mp4"
+}
+
+# telegram document id -> file_url of documents already in MinIO
+stored_documents = LRUDict(Config.CACHE_MAX_MEDIA, "media")
+# document id -> upload task, so concurrent messages with one document share a download
+_in_flight = {}
+
+
+def hash_stream(data):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: data.read(1024 * 1024), b""):
+        digest.update(chunk)
+    data.seek(0)
+    return digest.hexdigest()
+
+
+async def upload_document(client, media, extension):
+    """
+    download a document into a spooled buffer and stream it to MinIO under the hash
+    of its content. small files never touch the disk, larger ones roll over to a temp
+    file that is removed when the buffer is closed. the upload is skipped when another
+    document with the same content is already stored.
+    """
+    document_id = media.document.id
+    with tempfile.SpooledTemporaryFile(max_size=Config.MEDIA_SPOOL_MAX_SIZE) as buffer:
+        async def download():
+            # a download retried after a flood wait starts over
+            buffer.seek(0)
+            buffer.truncate()
+            return await client.download_media(media, file=buffer)
+
+        await governor.call("download_media", download)
+        length = buffer.tell()
+        buffer.seek(0)
+        sha256 = await asyncio.to_thread(hash_stream, buffer)
+
+        file_url = await find_media_object(sha256=sha256)
+        if file_url is None:
+            started = time.perf_counter()
+            file_url = await asyncio.to_thread(
+                upload_stream, buffer, length, f"media/{sha256}.{extension}",
+                CONTENT_TYPES.get(extension, "application/octet-stream")
+            )
+            MEDIA_UPLOAD_SECONDS.observe(time.perf_counter() - started)
+
+    await store_media_object(document_id, sha256, file_url, length)
+    return file_url
+
+
+async def get_document_url(client, media, extension):
+    """file_url of a document, downloaded at most once per worker however many messages share it."""
+    document_id = media.document.id
+    file_url = stored_documents.get(document_id)
+    if file_url is None:
+        file_url = await find_media_object(document_id=document_id)
+    if file_url is not None:
+        MEDIA_DEDUPLICATED.inc()
+        stored_documents[document_id] = file_url
+        return file_url
+
+    task = _in_flight.get(document_id)
+    if task is None:
+        task = asyncio.create_task(upload_document(client, media, extension))
+        _in_flight[document_id] = task
+        task.add_done_callback(lambda _: _in_flight.pop(document_id, None))
+    else:
+        MEDIA_DEDUPLICATED.inc()
+
+    file_url = await asyncio.shield(task)
+    stored_documents[document_id] = file_url
+    return file_url
+
+
+async def download_and_store_media(client, media, chat_id, message_id, extension):
+    """
+    store a voice message or circle once per document and point the message at it.
+    raises ChatParked when downloads are flood limited, so the job can be retried.
+    """
+    try:
+        file_url = await get_document_url(client, media, extension)
+        await update_message_with_file_url(chat_id, message_id, file_url)
+    except ChatParked:
+        raise
+    except Exception as e:
+        logger.error(f"Error loading media file for message {message_id}: {e}")
+
+
+class MediaPipeline:
+    """
+    Queue of media jobs processed by a pool of download workers.
+
+    submit() never waits, so the writer of committed batches isn't held up by
+    downloads. Producers call wait_for_room() before they add more work, so
+    media bursts slow down scraping instead of piling up in memory once
+    queue_size jobs are waiting. A flood limited download
+    is retried by the same worker after the wait: every worker downloads
+    through the same governed method, so none of them could go on meanwhile.
+    """
+
+    def __init__(self, client, workers=None, queue_size=None):
+        self.client = client
+        self.workers = workers or Config.MEDIA_WORKERS
+        self.queue_size = queue_size or Config.MEDIA_QUEUE_SIZE
+        self._queue = asyncio.Queue()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, media, chat_id, message_id, extension):
+        self._queue.put_nowait((media, chat_id, message_id, extension))
+        if self._queue.qsize() >= self.queue_size:
+            self._room.clear()
+        MEDIA_QUEUE_DEPTH.set(self._queue.qsize())
+
+    async def wait_for_room(self):
+        """wait while queue_size or more jobs are waiting for a worker."""
+        await self._room.wait()
+
+    async def close(self):
+        """wait for queued jobs and stop the workers."""
+        if self._tasks:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            media, chat_id, message_id, extension = await self._queue.get()
+            if self._queue.qsize() < self.queue_size:
+                self._room.set()
+            MEDIA_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                while True:
+                    try:
+                        await download_and_store_media(self.client, media, chat_id, message_id, extension)
+                        break
+                    except ChatParked as e:
+                        logger.warning(f"Media downloads are flood limited, waiting {e.seconds:.0f} seconds.")
+                        await asyncio.sleep(e.seconds)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,49 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from .config import Config
+from .logging_setup import logger
+
+MESSAGES_INGESTED = Counter(
+    "scraper_messages_ingested_total", "Messages written to the database", ["chat_id"]
+)
+ITER_MESSAGES_SECONDS = Histogram(
+    "scraper_iter_messages_seconds", "Latency of one iter_messages batch",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+DB_FLUSH_SECONDS = Histogram(
+    "scraper_db_flush_seconds", "Latency of one ingestion flush transaction",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+DB_FLUSH_ROWS = Histogram(
+    "scraper_db_flush_rows", "Messages written per ingestion flush",
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+)
+DB_FLUSH_ERRORS = Counter(
+    "scraper_db_flush_errors_total", "Ingestion flushes that failed"
+)
+MEDIA_QUEUE_DEPTH = Gauge(
+    "scraper_media_queue_depth", "Media jobs waiting for a download worker"
+)
+MEDIA_UPLOAD_SECONDS = Histogram(
+    "scraper_media_upload_seconds", "Latency of one media upload to MinIO",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+SPOOL_SEGMENTS = Gauge(
+    "scraper_spool_segments", "Flushed batches spooled locally and not yet committed to the database"
+)
+MEDIA_DEDUPLICATED = Counter(
+    "scraper_media_deduplicated_total", "Media files served from an already stored document instead of a download"
+)
+FLOOD_WAIT_SECONDS = Counter(
+    "scraper_flood_wait_seconds_total", "Seconds of flood wait reported by FloodWaitError"
+)
+CACHE_LOOKUPS = Counter(
+    "scraper_cache_lookups_total", "Lookups in the in-process id caches", ["cache", "result"]
+)
+
+
+def start_metrics_server():
+    if Config.METRICS_PORT:
+        start_http_server(Config.METRICS_PORT)
+        logger.info(f"Metrics are exposed on port {Config.METRICS_PORT}.")
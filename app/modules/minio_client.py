@@ -1,7 +1,8 @@
 from minio import Minio
 import os
+import threading
 
-MINIO_URL = "nginx:9000"
+MINIO_URL = os.getenv("MINIO_URL", "nginx:9000")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ROOT_USER", "minioadmin")
 MINIO_SECRET_KEY = os.getenv("MINIO_ROOT_PASSWORD", "minioadmin")
 BUCKET_NAME = "telegram-bucket"
@@ -13,11 +14,29 @@ minio_client = Minio(
     secure=False
 )
 
-if not minio_client.bucket_exists(BUCKET_NAME):
-    minio_client.make_bucket(BUCKET_NAME)
+_bucket_lock = threading.Lock()
+_bucket_ready = False
+
+
+def ensure_bucket():
+    """Creates the bucket on first upload, so importing the module needs no MinIO connection."""
+    global _bucket_ready
+    with _bucket_lock:
+        if not _bucket_ready:
+            if not minio_client.bucket_exists(BUCKET_NAME):
+                minio_client.make_bucket(BUCKET_NAME)
+            _bucket_ready = True
 
 
 def upload_file(file_path, object_name):
     """Uploads a file to MinIO."""
+    ensure_bucket()
     minio_client.fput_object(BUCKET_NAME, object_name, file_path)
     return f"{MINIO_URL}/{BUCKET_NAME}/{object_name}"
+
+
+def upload_stream(data, length, object_name, content_type="application/octet-stream"):
+    """Uploads a file-like object to MinIO, large objects are sent as multipart upload."""
+    ensure_bucket()
+    minio_client.put_object(BUCKET_NAME, object_name, data, length, content_type=content_type)
+    return f"{MINIO_URL}/{BUCKET_NAME}/{object_name}"
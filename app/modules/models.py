@@ -1,7 +1,7 @@
 from datetime import datetime
 
-from sqlalchemy import Boolean, DateTime, Integer, Text
-from sqlalchemy import Column, BigInteger, String, ForeignKey
+from sqlalchemy import Boolean, DateTime, Integer, Text, text
+from sqlalchemy import Column, BigInteger, String, ForeignKey, Index, FetchedValue, Computed
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -55,11 +55,18 @@ class UserHistory(Base):
 
 class Message(Base):
     __tablename__ = 'messages'
-
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    message_id = Column(BigInteger, nullable=False, unique=True)
+    __table_args__ = (
+        Index('idx_messages_chat_timestamp', 'chat_id', 'timestamp'),
+        Index('idx_messages_user_timestamp', 'user_id', 'timestamp'),
+        Index('idx_messages_fingerprint', 'chat_id', 'message_id',
+              postgresql_include=['text_hash', 'edit_date'], postgresql_where=text('NOT deleted')),
+        {'postgresql_partition_by': 'HASH (chat_id)'},
+    )
+
+    id = Column(BigInteger, nullable=False, server_default=FetchedValue())
+    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    message_id = Column(BigInteger, primary_key=True)
     user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
-    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), nullable=False)
     message_text = Column(Text, nullable=False)
     timestamp = Column(DateTime, nullable=False)
 
@@ -68,6 +75,97 @@ class Message(Base):
 
     file_url = Column(Text, nullable=True)
 
+    # first 64 bits of md5(message_text), compared with fetched messages by reconciliation
+    text_hash = Column(BigInteger, Computed("('x' || left(md5(message_text), 16))::bit(64)::bigint"))
+    edit_date = Column(DateTime, nullable=True)
+    deleted = Column(Boolean, nullable=False, default=False)
+
     user = relationship("User", foreign_keys=[user_id])
     chat = relationship("Chat")
     forwarded_from_user = relationship("User", foreign_keys=[forwarded_from_user_id])
+
+
+class ScrapeState(Base):
+    __tablename__ = 'scrape_state'
+
+    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    topic_id = Column(BigInteger, primary_key=True, default=0)
+    last_message_id = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ChatLease(Base):
+    __tablename__ = 'chat_leases'
+
+    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    worker = Column(BigInteger, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    backlog = Column(BigInteger, nullable=False, default=0)
+
+
+class Worker(Base):
+    __tablename__ = 'workers'
+
+    id = Column(BigInteger, primary_key=True)
+    heartbeat_at = Column(DateTime, nullable=False)
+    flood_wait_until = Column(DateTime, nullable=True)
+
+
+class WorkerDialog(Base):
+    __tablename__ = 'worker_dialogs'
+
+    worker = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+
+
+class MediaObject(Base):
+    __tablename__ = 'media_objects'
+
+    document_id = Column(BigInteger, primary_key=True)
+    sha256 = Column(String(64), nullable=False, index=True)
+    file_url = Column(Text, nullable=False)
+    size = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class BackfillRange(Base):
+    __tablename__ = 'backfill_ranges'
+
+    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    start_id = Column(BigInteger, primary_key=True)
+    end_id = Column(BigInteger, nullable=False)
+    last_message_id = Column(BigInteger, nullable=False)
+    done = Column(Boolean, nullable=False, default=False)
+    worker = Column(BigInteger, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+
+
+class UserChatActivity(Base):
+    __tablename__ = 'user_chat_activity'
+    __table_args__ = (
+        Index('idx_user_chat_activity_chat', 'chat_id', 'message_count'),
+    )
+
+    user_id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    message_count = Column(BigInteger, nullable=False, default=0)
+    first_message_at = Column(DateTime, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+
+
+class ChatActivity(Base):
+    __tablename__ = 'chat_activity'
+
+    chat_id = Column(BigInteger, ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    message_count = Column(BigInteger, nullable=False, default=0)
+    user_count = Column(BigInteger, nullable=False, default=0)
+    first_message_at = Column(DateTime, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+
+
+class ExportWatermark(Base):
+    __tablename__ = 'export_watermarks'
+
+    name = Column(String(64), primary_key=True)
+    last_id = Column(BigInteger, nullable=False)
+    exported_at = Column(DateTime, default=datetime.utcnow)
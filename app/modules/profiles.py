@@ -0,0 +1,112 @@
+import asyncio
+
+import telethon
+from telethon.tl.functions.users import GetUsersRequest
+
+from .cache import LRUDict
+from .config import Config
+from .db_operations import PROFILE_FIELDS, store_user_profiles
+from .governor import ChatParked, governor
+from .logging_setup import logger
+
+
+def build_user_row(user_id, entity=None):
+    """users row for a sender or forward source, empty profile if entity is not a telegram user."""
+    if isinstance(entity, telethon.tl.types.User):
+        return {
+            "id": user_id,
+            "username": entity.username,
+            "first_name": entity.first_name,
+            "last_name": entity.last_name,
+            "deleted": entity.deleted,
+            "premium": entity.premium
+        }
+    return {
+        "id": user_id,
+        "username": None,
+        "first_name": None,
+        "last_name": None,
+        "deleted": False,
+        "premium": False
+    }
+
+
+def profile_fingerprint(row):
+    return hash(tuple(row[field] for field in PROFILE_FIELDS))
+
+
+def entity_fingerprint(entity):
+    """profile_fingerprint of build_user_row(entity.id, entity), without building the row."""
+    return hash(tuple(getattr(entity, field) for field in PROFILE_FIELDS))
+
+
+class ProfileResolver:
+    """
+    Collects user profiles that telegram already delivered with messages.
+
+    Only ids without a delivered sender are fetched, in batches of
+    PROFILE_BATCH_SIZE with GetUsersRequest. A fingerprint of every stored
+    profile is kept in memory, so a profile is only written again when it changed.
+    """
+
+    def __init__(self, client, batch_size=None):
+        self.client = client
+        self.batch_size = batch_size or Config.PROFILE_BATCH_SIZE
+
+        self._pending = {}
+        self._missing = set()
+        self._stored = LRUDict(Config.CACHE_MAX_USERS, "profiles")
+        self._lock = asyncio.Lock()
+
+    def observe(self, entity):
+        if not isinstance(entity, telethon.tl.types.User):
+            return
+        user_id = entity.id
+        # most senders repeat, the row is only built for profiles that changed
+        if self._stored.get(user_id) != entity_fingerprint(entity):
+            self._pending[user_id] = build_user_row(user_id, entity)
+        self._missing.discard(user_id)
+
+    def request(self, user_id):
+        # positive ids are users, channels and chats have negative marked ids
+        if user_id > 0 and user_id not in self._pending and user_id not in self._stored:
+            self._missing.add(user_id)
+
+    async def flush(self):
+        async with self._lock:
+            await self._resolve_missing()
+
+            profiles, self._pending = self._pending, {}
+            if not profiles:
+                return
+
+            if await store_user_profiles(profiles):
+                for user_id, row in profiles.items():
+                    self._stored[user_id] = profile_fingerprint(row)
+
+    async def _resolve_missing(self):
+        user_ids, self._missing = list(self._missing), set()
+
+        for i in range(0, len(user_ids), self.batch_size):
+            input_users = []
+            for user_id in user_ids[i:i + self.batch_size]:
+                try:
+                    input_users.append(await self.client.get_input_entity(user_id))
+                except Exception as e:
+                    logger.warning(f"No access hash for user {user_id}: {e}")
+
+            if not input_users:
+                continue
+
+            try:
+                users = await governor.call("GetUsersRequest", lambda: self.client(GetUsersRequest(input_users)))
+            except ChatParked:
+                # flood limited, the rest is retried on the next flush
+                self._missing.update(user_ids[i:])
+                return
+            except Exception as e:
+                logger.error(f"Error getting information for {len(input_users)} users: {e}")
+                continue
+
+            for user in users:
+                self.observe(user)
@@ -0,0 +1,135 @@
+from sqlalchemy import func, literal_column
+from sqlalchemy.future import select
+
+from .db import ReadSessionLocal
+from .models import Chat, ChatActivity, Message, User, UserChatActivity, UserHistory
+
+# must match the expression of idx_messages_search, otherwise the index is not used
+SEARCH_CONFIG = literal_column("'simple'")
+search_vector = func.to_tsvector(SEARCH_CONFIG, Message.message_text)
+
+
+def message_columns():
+    return (
+        Message.chat_id, Message.message_id, Message.user_id, Message.timestamp,
+        Message.message_text, Message.file_url, Message.deleted
+    )
+
+
+async def search_messages(query, chat_id=None, user_id=None, before=None, limit=50):
+    """
+    newest messages matching a websearch query ("quoted phrase", -excluded, or),
+    before is the timestamp of the last message of the previous page.
+    """
+    stmt = (
+        select(*message_columns())
+        .where(search_vector.op("@@")(func.websearch_to_tsquery(SEARCH_CONFIG, query)))
+        .order_by(Message.timestamp.desc())
+        .limit(limit)
+    )
+    if chat_id is not None:
+        stmt = stmt.where(Message.chat_id == chat_id)
+    if user_id is not None:
+        stmt = stmt.where(Message.user_id == user_id)
+    if before is not None:
+        stmt = stmt.where(Message.timestamp < before)
+
+    async with ReadSessionLocal() as session:
+        result = await session.execute(stmt)
+        return [dict(row._mapping) for row in result]
+
+
+async def user_timeline(user_id, chat_id=None, before=None, limit=50):
+    """messages of a user, newest first, paged by the timestamp of the last message of the previous page."""
+    stmt = (
+        select(*message_columns())
+        .where(Message.user_id == user_id)
+        .order_by(Message.timestamp.desc())
+        .limit(limit)
+    )
+    if chat_id is not None:
+        stmt = stmt.where(Message.chat_id == chat_id)
+    if before is not None:
+        stmt = stmt.where(Message.timestamp < before)
+
+    async with ReadSessionLocal() as session:
+        result = await session.execute(stmt)
+        return [dict(row._mapping) for row in result]
+
+
+async def user_summary(user_id):
+    """profile, chats with message counts and profile history of a user, None if the user is unknown."""
+    async with ReadSessionLocal() as session:
+        user = await session.get(User, user_id)
+        if user is None:
+            return None
+
+        chats = await session.execute(
+            select(
+                UserChatActivity.chat_id, Chat.title, UserChatActivity.message_count,
+                UserChatActivity.first_message_at, UserChatActivity.last_message_at
+            )
+            .join(Chat, Chat.id == UserChatActivity.chat_id)
+            .where(UserChatActivity.user_id == user_id)
+            .order_by(UserChatActivity.last_message_at.desc())
+        )
+        history = await session.execute(
+            select(
+                UserHistory.timestamp, UserHistory.username, UserHistory.first_name, UserHistory.last_name,
+                UserHistory.deleted, UserHistory.premium
+            )
+            .where(UserHistory.user_id == user_id)
+            .order_by(UserHistory.timestamp.desc())
+        )
+
+        return {
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "deleted": user.deleted,
+            "premium": user.premium,
+            "chats": [dict(row._mapping) for row in chats],
+            "history": [dict(row._mapping) for row in history]
+        }
+
+
+async def chat_summary(chat_id, limit=50, offset=0):
+    """message and member counts of a chat with its most active members."""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Chat.id, Chat.title, ChatActivity.message_count, ChatActivity.user_count,
+                   ChatActivity.first_message_at, ChatActivity.last_message_at)
+            .outerjoin(ChatActivity, ChatActivity.chat_id == Chat.id)
+            .where(Chat.id == chat_id)
+        )
+        chat = result.first()
+        if chat is None:
+            return None
+
+        members = await session.execute(
+            select(
+                UserChatActivity.user_id, User.username, User.first_name, User.last_name,
+                UserChatActivity.message_count, UserChatActivity.last_message_at
+            )
+            .outerjoin(User, User.id == UserChatActivity.user_id)
+            .where(UserChatActivity.chat_id == chat_id)
+            .order_by(UserChatActivity.message_count.desc())
+            .limit(limit)
+            .offset(offset)
+        )
+
+        return {**chat._mapping, "members": [dict(row._mapping) for row in members]}
+
+
+async def shared_chats(user_ids):
+    """chats all of the given users have written in."""
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(UserChatActivity.chat_id, Chat.title)
+            .join(Chat, Chat.id == UserChatActivity.chat_id)
+            .where(UserChatActivity.user_id.in_(user_ids))
+            .group_by(UserChatActivity.chat_id, Chat.title)
+            .having(func.count() == len(set(user_ids)))
+        )
+        return [dict(row._mapping) for row in result]
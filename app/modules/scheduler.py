@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from .config import Config
+from .logging_setup import logger
+
+
+class TokenBucket:
+    """Global rate limiter for telegram requests, shared by all chats scraped by the worker."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+rate_limiter = TokenBucket(Config.API_RATE_LIMIT, Config.API_RATE_BURST)
+
+
+class SweepParked(Exception):
+    """a job had to be parked for longer than the scheduler may wait, the run is given up."""
+
+    def __init__(self, seconds):
+        super().__init__(f"sweep parked for {seconds:.0f} seconds")
+        self.seconds = seconds
+
+
+class ChatScheduler:
+    """
+    Runs chat/topic jobs with bounded concurrency.
+
+    A job is an async generator that yields after every message batch. Workers
+    advance a job by one batch and put it back at the end of the queue, so
+    long chats can't starve short ones. A job that yields a number of seconds
+    is parked: it leaves the queue and is put back after that delay, without
+    holding a worker. A delay longer than max_park ends run() with SweepParked.
+    """
+
+    def __init__(self, concurrency=None, max_park=None):
+        self.concurrency = concurrency or Config.SCRAPE_CONCURRENCY
+        self.max_park = max_park
+        self._queue = asyncio.Queue()
+        self._active = 0
+        self._done = asyncio.Event()
+        self._parked = set()
+
+    def submit(self, name, job):
+        self._active += 1
+        self._done.clear()
+        self._queue.put_nowait((name, job))
+
+    async def run(self):
+        if not self._active:
+            return
+
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        done_waiter = asyncio.create_task(self._done.wait())
+
+        try:
+            done, _ = await asyncio.wait([done_waiter, *workers], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            tasks = [done_waiter, *workers, *self._parked]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        for task in done:
+            if task is not done_waiter:
+                task.result()
+
+    def _finish(self):
+        self._active -= 1
+        if not self._active:
+            self._done.set()
+
+    def _park(self, name, job, delay):
+        logger.info(f"{name} parked for {delay:.0f} seconds.")
+
+        async def resume():
+            await asyncio.sleep(delay)
+            self._queue.put_nowait((name, job))
+
+        task = asyncio.create_task(resume())
+        self._parked.add(task)
+        task.add_done_callback(self._parked.discard)
+
+    async def _worker(self):
+        while True:
+            name, job = await self._queue.get()
+            try:
+                delay = await anext(job)
+            except StopAsyncIteration:
+                self._finish()
+            except Exception as e:
+                logger.error(f"Error processing {name}: {e}")
+                self._finish()
+            else:
+                if delay and self.max_park is not None and delay > self.max_park:
+                    raise SweepParked(delay)
+                if delay:
+                    self._park(name, job, delay)
+                else:
+                    self._queue.put_nowait((name, job))
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import pickle
+from collections import deque
+
+from .logging_setup import logger
+from .metrics import SPOOL_SEGMENTS
+
+SUFFIX = ".seg"
+
+
+class Spool:
+    """
+    Append-only local spool of flushed batches, one segment file per batch.
+
+    A segment is written to a temporary file, fsynced and renamed into place,
+    so after a crash every segment in the directory is complete. Segments are
+    handed out oldest first and removed once acknowledged; the ones left on
+    disk at startup are replayed. Unreadable and rejected segments are kept
+    next to the spool with a .bad suffix. append() waits while max_segments are
+    pending, so a long database outage slows scraping down instead of filling
+    the disk.
+    """
+
+    def __init__(self, directory, max_segments):
+        self.directory = directory
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+
+        files = os.listdir(directory)
+        names = sorted(name for name in files if name.endswith(SUFFIX))
+        self._pending = deque(os.path.join(directory, name) for name in names)
+        # numbers of .bad segments aren't reused, so a later one can't overwrite them
+        numbers = [int(name.split(".")[0]) for name in files if name.split(".")[0].isdigit()]
+        self._next_seq = max(numbers) + 1 if numbers else 0
+
+        self._appended = asyncio.Event()
+        self._acked = asyncio.Event()
+        if self._pending:
+            self._appended.set()
+            logger.info(f"Replaying {len(self._pending)} spooled batches from {directory}.")
+        SPOOL_SEGMENTS.set(len(self._pending))
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def append(self, batch):
+        while len(self._pending) >= self.max_segments:
+            self._acked.clear()
+            await self._acked.wait()
+
+        path = os.path.join(self.directory, f"{self._next_seq:012d}{SUFFIX}")
+        self._next_seq += 1
+        await asyncio.to_thread(self._write, path, batch)
+
+        self._pending.append(path)
+        self._appended.set()
+        SPOOL_SEGMENTS.set(len(self._pending))
+
+    async def next(self):
+        """oldest pending segment as (path, batch), waits until there is one."""
+        while True:
+            while not self._pending:
+                self._appended.clear()
+                await self._appended.wait()
+
+            path = self._pending[0]
+            try:
+                return path, await asyncio.to_thread(self._read, path)
+            except Exception as e:
+                logger.error(f"Unreadable spool segment {path}, moved aside: {e}")
+                await asyncio.to_thread(os.replace, path, path + ".bad")
+                self._pending.popleft()
+
+    async def ack(self, path):
+        await asyncio.to_thread(os.remove, path)
+        self._pending.remove(path)
+        self._acked.set()
+        SPOOL_SEGMENTS.set(len(self._pending))
+
+    async def reject(self, path):
+        """move a segment the database refuses aside, so the ones after it can be written."""
+        await asyncio.to_thread(os.replace, path, path + ".bad")
+        self._pending.remove(path)
+        self._acked.set()
+        SPOOL_SEGMENTS.set(len(self._pending))
+
+    async def drained(self):
+        while self._pending:
+            self._acked.clear()
+            await self._acked.wait()
+
+    @staticmethod
+    def _write(path, batch):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
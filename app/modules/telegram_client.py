@@ -1,20 +1,31 @@
-import asyncio
+import time
 
 import telethon
 from telethon.errors import ChannelPrivateError, ChatAdminRequiredError, InviteHashExpiredError, PeerIdInvalidError, \
-    FloodWaitError
+    UserAlreadyParticipantError
 from telethon.tl.functions.channels import GetForumTopicsRequest
 from telethon.tl.functions.messages import ImportChatInviteRequest
-from telethon.tl.types import Channel
-
-from .db_operations import update_user_data, store_message_in_db, get_last_message_id_for_chat, get_chats_for_worker
+from telethon.tl.types import Channel, ForumTopicDeleted
+
+from .backfill import claim_range, get_backfill_chats, plan_backfill
+from .cache import warm_cache
+from .config import Config
+from .db_operations import get_chats_for_worker, get_message_fingerprints, text_hash
+from .dialogs import dialog_index
+from .governor import ChatParked, governor
+from .ingestion import IngestionBuffer, naive_utc
 from .logging_setup import logger
+from .metrics import ITER_MESSAGES_SECONDS
+from .scheduler import ChatScheduler
+
+# forum id -> (monotonic time of the fetch, topics)
+forum_topics_cache = {}
 
 
 async def get_chat_details(client, chat_id):
     """Get detailed information about a chat"""
     try:
-        chat = await client.get_entity(chat_id)
+        chat = await governor.call("get_entity", lambda: client.get_entity(chat_id))
 
         if chat.username is not None:
             print("Dialog is public")
@@ -46,130 +57,341 @@ async def get_chat_details(client, chat_id):
         else:
             details = None
         return details
+    except ChatParked:
+        raise
     except Exception as e:
         logger.error(f"Error getting chat information {chat_id}: {e}")
         return None
 
 
-async def gather_all_users(client, worker_id, batch_size=100):
-    """get information about users from all chats and collect information about chats in the form of a dictionary."""
+async def gather_all_users(client, worker_id, batch_size=100, coordinator=None):
+    """scrape all chats of the worker, users and their chats are streamed to the database as they are seen."""
     chat_details_map = {}
     
-    chats = await get_chats_for_worker(worker_id)
+    if coordinator:
+        chats = await coordinator.acquire()
+    else:
+        chats = await get_chats_for_worker(worker_id)
+    await warm_cache([chat.id for chat in chats])
+    await dialog_index.load(client, worker_id)
     
-    user_chat_map = {}
+    buffer = IngestionBuffer(client)
+    await buffer.load_checkpoints([chat.id for chat in chats])
+    buffer.start()
+
+    try:
+        await sweep_chats(client, worker_id, chats, buffer, batch_size, chat_details_map, coordinator)
+    finally:
+        await buffer.close()
+
+    if coordinator:
+        await coordinator.report(buffer.scraped)
 
+    return chat_details_map
+
+
+async def sweep_chats(client, worker_id, chats, buffer, batch_size, chat_details_map, coordinator=None):
+    """
+    scrape all chats from their checkpoints up to the latest message, together with unfinished backfills.
+    with a coordinator, a chat parked for longer than LEASE_TTL raises SweepParked, so the worker
+    can hand its chats to others instead of keeping their leases while it waits.
+    """
+    scheduler = ChatScheduler(max_park=Config.LEASE_TTL if coordinator else None)
     for chat in chats:
+        scheduler.submit(
+            chat.title, scrape_chat(client, scheduler, worker_id, chat, buffer, batch_size, chat_details_map)
+        )
+
+    if Config.RECONCILE_LOOKBACK:
+        for chat in chats:
+            scheduler.submit(f"{chat.title}/reconcile", reconcile_chat(client, chat, buffer, Config.RECONCILE_LOOKBACK))
+
+    if Config.BACKFILL_ENABLED:
+        chat_ids = None if Config.BACKFILL_SHARED else [chat.id for chat in chats]
+        for chat in await get_backfill_chats(chat_ids):
+            submit_backfill(client, scheduler, worker_id, chat, buffer, batch_size)
+
+    await scheduler.run()
+
+
+def submit_backfill(client, scheduler, worker_id, chat, buffer, batch_size):
+    for i in range(Config.BACKFILL_PARALLELISM):
+        scheduler.submit(
+            f"{chat.title}/backfill{i}", scrape_ranges(client, worker_id, chat, buffer, batch_size)
+        )
+
+
+async def scrape_chat(client, scheduler, worker_id, chat, buffer, batch_size, chat_details_map):
+    """
+    scheduler job for one chat, topics of a forum are submitted as separate jobs.
+    yields the number of seconds to park the chat for when a request is flood limited.
+    """
+    while chat.id not in chat_details_map:
         try:
-            if chat.id not in chat_details_map:
-                chat_details = await get_chat_details(client, chat.id)
-                if chat_details:
-                    chat_details_map[chat.id] = chat_details
+            chat_details = await get_chat_details(client, chat.id)
+        except ChatParked as e:
+            yield e.seconds
+            continue
+        if not chat_details:
+            return
+        chat_details_map[chat.id] = chat_details
 
-            if chat_details_map[chat.id]["is_forum"]:
+    yield
+
+    if chat_details_map[chat.id]["is_forum"]:
+        while True:
+            try:
                 topics = await get_forum_topics(client, chat.id)
-                for topic in topics:
-                    users = await get_chat_users(client, topic, batch_size, chat.invite_link_id)
-                    for user_id in users:
-                        await update_user_info_in_map(client, user_id, user_chat_map, chat)
-            else:
-                users = await get_chat_users(client, chat, batch_size, chat.invite_link_id)
-                for user_id in users:
-                    await update_user_info_in_map(client, user_id, user_chat_map, chat)
+                break
+            except ChatParked as e:
+                yield e.seconds
+        for topic in topics:
+            # topics without messages after the checkpoint are skipped without a request
+            if topic.top_message <= buffer.checkpoints.get((chat.id, topic.id), 0):
+                continue
+            scheduler.submit(
+                f"{chat.title}/{topic.title}", scrape_target(client, chat, buffer, batch_size, topic.id)
+            )
+    else:
+        if Config.BACKFILL_ENABLED and (chat.id, 0) not in buffer.checkpoints:
+            async for delay in start_backfill(client, scheduler, worker_id, chat, buffer, batch_size):
+                yield delay
+        async for delay in scrape_target(client, chat, buffer, batch_size):
+            yield delay
+
+
+async def start_backfill(client, scheduler, worker_id, chat, buffer, batch_size):
+    """
+    split the history of a chat scraped for the first time into message id ranges
+    that are scraped concurrently, when it has at least BACKFILL_MIN_MESSAGES messages.
+    """
+    while True:
+        try:
+            peer = await get_peer(client, chat, chat.invite_link_id)
+            if peer is None:
+                return
+            messages = await governor.call("get_messages", lambda: client.get_messages(peer, limit=1))
+            break
+        except ChatParked as e:
+            yield e.seconds
+        except Exception as e:
+            logger.error(f"Error getting the latest message of chat {chat.title}: {e}")
+            return
+
+    top_message_id = messages[0].id if messages else 0
+    if top_message_id < Config.BACKFILL_MIN_MESSAGES:
+        return
+
+    await plan_backfill(chat.id, top_message_id)
+    buffer.checkpoints[(chat.id, 0)] = top_message_id
+    submit_backfill(client, scheduler, worker_id, chat, buffer, batch_size)
+
+
+async def scrape_ranges(client, worker_id, chat, buffer, batch_size):
+    """scheduler job that leases backfill ranges of a chat one after another until none is left."""
+    while True:
+        backfill_range = await claim_range(worker_id, chat.id)
+        if backfill_range is None:
+            return
+        async for delay in iter_chat_users(
+                client, chat, buffer, batch_size, chat.invite_link_id, backfill_range=backfill_range
+        ):
+            yield delay
+
+
+async def scrape_target(client, chat, buffer, batch_size, topic_id=0):
+    """scheduler job for a chat or a forum topic, yields after every message batch."""
+    async for delay in iter_chat_users(client, chat, buffer, batch_size, chat.invite_link_id, topic_id):
+        yield delay
+
+    await buffer.profiles.flush()
+
 
+async def reconcile_chat(client, chat, buffer, lookback):
+    """
+    scheduler job that re-reads the latest lookback stored messages of a chat and
+    compares them with their stored fingerprints. changed messages are buffered as
+    edits, messages telegram no longer returns are marked deleted.
+    """
+    stored = await get_message_fingerprints(chat.id, lookback)
+    if not stored:
+        return
+
+    while True:
+        try:
+            peer = await get_peer(client, chat, chat.invite_link_id)
+            if peer is None:
+                return
+            messages = await governor.collect("iter_messages", lambda: client.iter_messages(
+                peer, min_id=min(stored) - 1, max_id=max(stored) + 1
+            ))
+            break
+        except ChatParked as e:
+            yield e.seconds
         except Exception as e:
-            logger.error(f"Error processing the chat {chat.title}: {e}")
+            logger.error(f"Error reconciling chat {chat.title}: {e}")
+            return
+
+    # nothing at all usually means the chat can't be read any more, not that everything was deleted
+    if not messages:
+        return
+
+    seen = set()
+    edited = 0
+    for message in messages:
+        fingerprint = stored.get(message.id)
+        if fingerprint is None:
+            continue
+        seen.add(message.id)
+
+        stored_hash, stored_edit_date = fingerprint
+        edit_date = naive_utc(message.edit_date)
+        if edit_date == stored_edit_date and stored_hash is not None:
             continue
-        except FloodWaitError as e:
-            logger.warning(f"Telegram request limit exceeded, waiting {e.seconds} seconds...")
-            await asyncio.sleep(e.seconds)  
+        if edit_date != stored_edit_date or text_hash(message.message or "[no text in message]") != stored_hash:
+            await buffer.add_edit(message, chat)
+            edited += 1
 
-    return user_chat_map, chat_details_map
+    deleted = [message_id for message_id in stored if message_id not in seen]
+    buffer.add_deletions(chat.id, deleted)
+    if edited or deleted:
+        logger.info(f"Chat {chat.title} reconciled: {edited} edited, {len(deleted)} deleted messages.")
 
 
 async def get_forum_topics(client, chat_id):
+    """all topics of a forum, fetched page by page and cached for FORUM_TOPICS_CACHE_TTL seconds."""
+    cached = forum_topics_cache.get(chat_id)
+    if cached and time.monotonic() - cached[0] < Config.FORUM_TOPICS_CACHE_TTL:
+        return cached[1]
+
     topics = []
+    fetched = 0
+    offset_date, offset_id, offset_topic = None, 0, 0
     try:
-        result = await client(GetForumTopicsRequest(
-            channel=chat_id,
-            offset_date=None,
-            offset_id=0,
-            offset_topic=0,
-            limit=100,
-            q=''
-        ))
-        topics = result.topics
+        while True:
+            result = await governor.call("GetForumTopicsRequest", lambda: client(GetForumTopicsRequest(
+                channel=chat_id,
+                offset_date=offset_date,
+                offset_id=offset_id,
+                offset_topic=offset_topic,
+                limit=Config.FORUM_TOPICS_PAGE_SIZE,
+                q=''
+            )))
+            page = result.topics
+            fetched += len(page)
+            topics.extend(topic for topic in page if not isinstance(topic, ForumTopicDeleted))
+            if len(page) < Config.FORUM_TOPICS_PAGE_SIZE or fetched >= result.count:
+                break
+
+            # topics are ordered by their last message, the next page starts after the last one of this page
+            last = page[-1]
+            dates = {message.id: message.date for message in result.messages}
+            offset_date = dates.get(getattr(last, "top_message", 0), getattr(last, "date", None))
+            offset_id = getattr(last, "top_message", 0)
+            offset_topic = last.id
+    except ChatParked:
+        raise
     except Exception as e:
         logger.error(f"Error getting topics for forum {chat_id}: {e}")
-    return topics
-
+        return topics
 
-async def update_user_info_in_map(client, user_id, user_chat_map, chat):
-    try:
-        user_info = await client.get_entity(user_id)
-        if isinstance(user_info, telethon.tl.types.User):
-            await update_user_data(
-                user_info.id,
-                user_info.first_name,
-                user_info.last_name,
-                user_info.username,
-                user_info.deleted,
-                user_info.premium
-            )
-            if user_info.id not in user_chat_map:
-                user_chat_map[user_info.id] = []
-            user_chat_map[user_info.id].append(chat)
-    except Exception as user_exc:
-        logger.error(f"Error getting user information {user_id}: {user_exc}")
+    forum_topics_cache[chat_id] = (time.monotonic(), topics)
+    logger.info(f"Forum {chat_id} has {len(topics)} topics.")
+    return topics
 
 
 async def join_closed_chat_if_needed(client, chat):
     try:
-        async for dialog in client.iter_dialogs():
-            if dialog.id == chat.id:
-                return
+        if chat.id in dialog_index:
+            return
 
         if chat.access_hash:
             invite_hash = chat.access_hash
-            await client(ImportChatInviteRequest(invite_hash))
+            await governor.call("ImportChatInviteRequest", lambda: client(ImportChatInviteRequest(invite_hash)))
+            await dialog_index.add(chat.id)
         else:
             logger.warning(f"There is no invite link for chat {chat.title}.")
+    except UserAlreadyParticipantError:
+        # joined from another device or missing from a stale index
+        await dialog_index.add(chat.id)
+    except ChatParked:
+        raise
     except Exception as e:
         logger.error(f"Error joining private chat {chat.title}: {e}")
 
 
-async def get_chat_users(client, chat, batch_size=500, invite_link_id=None):
-    """Get users from messages in chat or forum topic."""
-    user_ids = set()
-
-    last_message_id = await get_last_message_id_for_chat(chat.id)
-    offset_id = last_message_id if last_message_id else 0
-    total_messages = 0
-
+async def get_peer(client, chat, invite_link_id=None):
+    """peer to read a chat from, private chats are joined first. None if the chat can't be accessed."""
     if invite_link_id:
         try:
-            peer = await client.get_entity(invite_link_id)
+            return await governor.call("get_entity", lambda: client.get_entity(invite_link_id))
+        except ChatParked:
+            raise
         except Exception as e:
             logger.error(f"Error when receiving public chat {chat.title} by invite_link_id: {e}")
-            return user_ids
-    else: 
-        await join_closed_chat_if_needed(client, chat)
-        peer = telethon.tl.types.PeerChannel(channel_id=chat.id)
+            return None
+
+    await join_closed_chat_if_needed(client, chat)
+    peer = telethon.tl.types.PeerChannel(channel_id=chat.id)
+    try:
+        await client.get_input_entity(peer)
+    except Exception as e:
+        logger.error(f"Error receiving private chat entity {chat.title}: {e}")
+        return None
+    return peer
+
+
+async def iter_chat_users(client, chat, buffer, batch_size=500, invite_link_id=None, topic_id=0,
+                          backfill_range=None):
+    """
+    Get users from messages in chat or forum topic, yields after every message batch.
+    A flood limited request yields its wait in seconds and is retried once the scheduler resumes the job.
+    With backfill_range only messages of that range are read, progress is stored on the range
+    instead of the checkpoint of the chat.
+    """
+
+    if backfill_range is None:
+        offset_id = buffer.checkpoints.get((chat.id, topic_id), 0)
+        max_id = 0
+    else:
+        offset_id = backfill_range.last_message_id
+        max_id = backfill_range.end_id
+    total_messages = 0
+
+    while True:
         try:
-            await client.get_input_entity(peer)
-        except Exception as e:
-            logger.error(f"Error receiving private chat entity {chat.title}: {e}")
-            return user_ids
+            peer = await get_peer(client, chat, invite_link_id)
+            break
+        except ChatParked as e:
+            yield e.seconds
+    if peer is None:
+        return
 
     while True:
-        messages = []
+        async def fetch():
+            # timed once the governor lets the request through, local pacing is not telegram latency
+            started = time.perf_counter()
+            batch = [message async for message in client.iter_messages(
+                peer, limit=batch_size, offset_id=offset_id, max_id=max_id, reverse=True, reply_to=topic_id or None
+            )]
+            ITER_MESSAGES_SECONDS.observe(time.perf_counter() - started)
+            return batch
+
         try:
-            async for message in client.iter_messages(peer, limit=batch_size, offset_id=offset_id, reverse=True):
-                messages.append(message)
+            messages = await governor.call("iter_messages", fetch)
+        except ChatParked as e:
+            logger.warning(f"Chat {chat.title} is flood limited, parking it for {e.seconds:.0f} seconds.")
+            yield e.seconds
+            continue
         except ChannelPrivateError:
+            # the account was removed from the chat since the index was built
+            await dialog_index.discard(chat.id)
             try:
-                await join_closed_chat_if_needed(client, chat)
-                return await get_chat_users(client, chat, batch_size)
+                async for delay in iter_chat_users(
+                        client, chat, buffer, batch_size, topic_id=topic_id, backfill_range=backfill_range
+                ):
+                    yield delay
+                return
             except Exception as join_error:
                 logger.error(f"Error trying to join private chat {chat.title}: {join_error}")
                 break
@@ -187,39 +409,17 @@ async def get_chat_users(client, chat, batch_size=500, invite_link_id=None):
             break
 
         if not messages:
+            if backfill_range is not None:
+                buffer.add_range_progress(chat.id, backfill_range.start_id, offset_id, done=True)
             break
 
         for message in messages:
-            if message.sender_id:
-                user_ids.add(message.sender_id)
-
-                sender = message.sender
-                user_data = {
-                    "username": sender.username if isinstance(sender, telethon.tl.types.User) else None,
-                    "first_name": sender.first_name if isinstance(sender, telethon.tl.types.User) else None,
-                    "last_name": sender.last_name if isinstance(sender, telethon.tl.types.User) else None,
-                    "deleted": sender.deleted if isinstance(sender, telethon.tl.types.User) else False,
-                    "premium": sender.premium if isinstance(sender, telethon.tl.types.User) else False
-                }
-
-                await store_message_in_db(
-                    user_id=message.sender_id,
-                    chat_id=chat.id,
-                    message_id=message.id,
-                    message_text=message.message,
-                    timestamp=message.date,
-                    chat_title=chat.title,
-                    user_data=user_data,
-                    reply_to_message_id=message.reply_to_msg_id if message.is_reply else None,
-                    forwarded_from_user_id=message.forward.sender_id if message.forward else None,
-                    media=message.media,
-                    client=client
-                )
+            await buffer.add_message(message, chat, topic_id, checkpoint=backfill_range is None)
 
             offset_id = message.id
 
+        if backfill_range is not None:
+            buffer.add_range_progress(chat.id, backfill_range.start_id, offset_id)
         total_messages += len(messages)
 
-        await asyncio.sleep(1)
-
-    return user_ids
+        yield
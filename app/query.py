@@ -0,0 +1,77 @@
+"""
+Read-side queries over the collected data, printed as JSON.
+
+    python app/query.py search "voice chat" [--chat ID] [--user ID] [--before TIMESTAMP] [--limit N]
+    python app/query.py timeline USER_ID [--chat ID] [--before TIMESTAMP] [--limit N]
+    python app/query.py user USER_ID
+    python app/query.py chat CHAT_ID [--limit N] [--offset N]
+    python app/query.py shared USER_ID USER_ID...
+
+Queries run on READ_DATABASE_URL (a replica, by default the primary) in read only
+transactions limited by QUERY_STATEMENT_TIMEOUT milliseconds.
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime
+
+from modules import queries
+from modules.db import read_engine
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search = commands.add_parser("search", help="full-text search over message texts")
+    search.add_argument("query")
+    search.add_argument("--chat", type=int)
+    search.add_argument("--user", type=int)
+    search.add_argument("--before", type=datetime.fromisoformat, help="page before this UTC timestamp")
+    search.add_argument("--limit", type=int, default=50)
+
+    timeline = commands.add_parser("timeline", help="messages of a user, newest first")
+    timeline.add_argument("user_id", type=int)
+    timeline.add_argument("--chat", type=int)
+    timeline.add_argument("--before", type=datetime.fromisoformat, help="page before this UTC timestamp")
+    timeline.add_argument("--limit", type=int, default=50)
+
+    user = commands.add_parser("user", help="profile, chats and profile history of a user")
+    user.add_argument("user_id", type=int)
+
+    chat = commands.add_parser("chat", help="activity of a chat and its most active members")
+    chat.add_argument("chat_id", type=int)
+    chat.add_argument("--limit", type=int, default=50)
+    chat.add_argument("--offset", type=int, default=0)
+
+    shared = commands.add_parser("shared", help="chats all given users have written in")
+    shared.add_argument("user_ids", type=int, nargs="+")
+
+    return parser.parse_args()
+
+
+async def run(args):
+    if args.command == "search":
+        return await queries.search_messages(args.query, args.chat, args.user, args.before, args.limit)
+    if args.command == "timeline":
+        return await queries.user_timeline(args.user_id, args.chat, args.before, args.limit)
+    if args.command == "user":
+        return await queries.user_summary(args.user_id)
+    if args.command == "chat":
+        return await queries.chat_summary(args.chat_id, args.limit, args.offset)
+    if args.command == "shared":
+        return await queries.shared_chats(args.user_ids)
+
+
+async def main():
+    args = parse_args()
+    try:
+        result = await run(args)
+    finally:
+        await read_engine.dispose()
+
+    print(json.dumps(result, indent=2, ensure_ascii=False, default=str))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,272 @@
+"""
+Deterministic stand-in for telethon.TelegramClient used by the benchmark.
+
+Only the calls the scraper makes are implemented. Chats, topics, messages and
+senders are generated on the fly from the scenario seed, so large scenarios
+cost no memory up front and every run sees exactly the same data.
+"""
+import asyncio
+import bisect
+import random
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+from telethon.tl.functions.channels import GetForumTopicsRequest
+from telethon.tl.functions.messages import ImportChatInviteRequest
+from telethon.tl.functions.users import GetUsersRequest
+
+BASE_CHAT_ID = -1001000000000
+BASE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclass
+class Scenario:
+    worker_id: int = 777000
+    chats: int = 20
+    forums: int = 2
+    topics_per_forum: int = 10
+    messages_per_chat: int = 5000
+    users: int = 2000
+    # zipf exponent of the sender distribution, 0 is uniform
+    sender_skew: float = 1.1
+    media_ratio: float = 0.02
+    media_size: int = 32 * 1024
+    # number of distinct documents media is drawn from, like forwarded voice notes; 0 makes every file unique
+    media_documents: int = 0
+    latency: float = 0.05
+    flood_ratio: float = 0.0
+    flood_seconds: int = 1
+    seed: int = 42
+
+    @property
+    def chat_ids(self):
+        return [BASE_CHAT_ID - i for i in range(1, self.chats + 1)]
+
+    def is_forum(self, chat_id):
+        return BASE_CHAT_ID - chat_id <= self.forums
+
+
+class FakeMessage:
+    __slots__ = ("id", "chat_id", "sender_id", "sender", "date", "message", "media", "forward",
+                 "reply_to", "reply_to_msg_id", "edit_date")
+
+    @property
+    def is_reply(self):
+        return self.reply_to_msg_id is not None
+
+
+class FakeTelegramClient:
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.api_calls = Counter()
+        self.flood_waits = 0
+
+        self._rng = random.Random(scenario.seed)
+        weights = [1 / (rank + 1) ** scenario.sender_skew for rank in range(scenario.users)]
+        total = 0
+        self._sender_cdf = []
+        for weight in weights:
+            total += weight
+            self._sender_cdf.append(total)
+
+    async def _request(self, method):
+        self.api_calls[method] += 1
+        if self.scenario.latency:
+            await asyncio.sleep(self.scenario.latency)
+        if self.scenario.flood_ratio and self._rng.random() < self.scenario.flood_ratio:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.scenario.flood_seconds)
+
+    def _user(self, user_id):
+        return types.User(
+            id=user_id,
+            access_hash=user_id,
+            first_name=f"user{user_id}",
+            last_name=None,
+            username=f"user{user_id}",
+            deleted=False,
+            premium=user_id % 10 == 0
+        )
+
+    def _channel(self, chat_id):
+        return types.Channel(
+            id=chat_id,
+            title=f"chat{chat_id}",
+            photo=types.ChatPhotoEmpty(),
+            date=BASE_DATE,
+            megagroup=True,
+            restricted=False,
+            forum=self.scenario.is_forum(chat_id),
+            access_hash=0,
+            username=f"chat{-chat_id}"
+        )
+
+    def _topic_of(self, chat_id, message_id):
+        """topics own ids 1..topics_per_forum, later messages are spread over them."""
+        if not self.scenario.is_forum(chat_id):
+            return 0
+        topics = self.scenario.topics_per_forum
+        if message_id <= topics:
+            return message_id
+        return (message_id - 1) % topics + 1
+
+    def _message(self, chat_id, message_id):
+        rng = random.Random(hash((self.scenario.seed, chat_id, message_id)))
+        rank = bisect.bisect_left(self._sender_cdf, rng.random() * self._sender_cdf[-1])
+        user_id = rank + 1
+
+        message = FakeMessage()
+        message.id = message_id
+        message.chat_id = chat_id
+        message.sender_id = user_id
+        message.sender = self._user(user_id)
+        message.date = BASE_DATE + timedelta(seconds=message_id)
+        message.message = f"message {message_id} in {chat_id}"
+        message.forward = None
+        message.edit_date = None
+        message.media = None
+
+        topic_id = self._topic_of(chat_id, message_id)
+        if topic_id and message_id != topic_id:
+            message.reply_to = types.MessageReplyHeader(reply_to_msg_id=topic_id, forum_topic=True)
+            message.reply_to_msg_id = topic_id
+        else:
+            message.reply_to = None
+            message.reply_to_msg_id = None
+
+        if rng.random() < self.scenario.media_ratio:
+            if self.scenario.media_documents:
+                document_id = rng.randrange(self.scenario.media_documents) + 1
+            else:
+                document_id = hash((chat_id, message_id)) & 0x7fffffffffffffff
+            document = types.Document(
+                id=document_id,
+                access_hash=0,
+                file_reference=b"",
+                date=message.date,
+                mime_type="audio/ogg",
+                size=self.scenario.media_size,
+                dc_id=2,
+                attributes=[types.DocumentAttributeAudio(duration=5, voice=True)]
+            )
+            message.media = types.MessageMediaDocument(document=document)
+            message.message = ""
+
+        return message
+
+    @staticmethod
+    def _chat_id_of(peer):
+        if isinstance(peer, int):
+            return peer
+        if isinstance(peer, types.PeerChannel):
+            return peer.channel_id
+        return peer.id
+
+    async def get_me(self):
+        return SimpleNamespace(id=self.scenario.worker_id)
+
+    async def get_entity(self, entity):
+        await self._request("get_entity")
+        entity_id = self._chat_id_of(entity)
+        if entity_id in self.scenario.chat_ids:
+            return self._channel(entity_id)
+        if 0 < entity_id <= self.scenario.users:
+            return self._user(entity_id)
+        raise ValueError(f"Could not find the entity {entity}")
+
+    async def get_input_entity(self, entity):
+        if isinstance(entity, int) and 0 < entity <= self.scenario.users:
+            return types.InputPeerUser(user_id=entity, access_hash=entity)
+        return entity
+
+    async def iter_dialogs(self):
+        await self._request("iter_dialogs")
+        for chat_id in self.scenario.chat_ids:
+            yield SimpleNamespace(id=chat_id)
+
+    async def iter_messages(self, entity, limit=None, offset_id=0, reverse=False, reply_to=None, **kwargs):
+        await self._request("iter_messages")
+        chat_id = self._chat_id_of(entity)
+        total = self.scenario.messages_per_chat
+        limit = limit or total
+
+        message_id = max(offset_id, kwargs.get("min_id") or 0) + 1
+        max_id = kwargs.get("max_id") or total + 1
+        returned = 0
+        while message_id < max_id and message_id <= total and returned < limit:
+            if not reply_to or self._topic_of(chat_id, message_id) == reply_to:
+                yield self._message(chat_id, message_id)
+                returned += 1
+            message_id += 1
+
+    async def get_messages(self, entity, limit=None, reverse=False, **kwargs):
+        messages = [message async for message in self.iter_messages(entity, **kwargs)]
+        # like telegram, newest messages come first unless reverse is given
+        if not reverse:
+            messages.reverse()
+        return messages[:limit] if limit else messages
+
+    async def download_media(self, media, file=None):
+        await self._request("download_media")
+        # content depends on the document only, so deduplication by hash sees forwarded copies as equal
+        data = media.document.id.to_bytes(8, "little") * (self.scenario.media_size // 8)
+        if file is None:
+            return data
+        file.write(data)
+        return file
+
+    async def __call__(self, request):
+        await self._request(type(request).__name__)
+
+        if isinstance(request, GetForumTopicsRequest):
+            chat_id = self._chat_id_of(request.channel)
+            topic_ids = range(1, self.scenario.topics_per_forum + 1) if self.scenario.is_forum(chat_id) else []
+            topic_ids = [topic_id for topic_id in topic_ids if topic_id > (request.offset_topic or 0)]
+            topics = [
+                SimpleNamespace(id=topic_id, title=f"topic{topic_id}", top_message=topic_id, date=BASE_DATE)
+                for topic_id in topic_ids[:request.limit]
+            ]
+            return SimpleNamespace(topics=topics, count=self.scenario.topics_per_forum, messages=[])
+
+        if isinstance(request, GetUsersRequest):
+            return [self._user(getattr(user, "user_id", user)) for user in request.id]
+
+        if isinstance(request, ImportChatInviteRequest):
+            return None
+
+        raise NotImplementedError(type(request).__name__)
+
+    def add_event_handler(self, callback, event=None):
+        pass
+
+    def remove_event_handler(self, callback, event=None):
+        pass
+
+
+class FakeMinio:
+    """in-memory stand-in for minio.Minio, keeps only object sizes."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def bucket_exists(self, bucket_name):
+        return True
+
+    def make_bucket(self, bucket_name):
+        pass
+
+    def put_object(self, bucket_name, object_name, data, length, content_type=None, **kwargs):
+        read = 0
+        while read < length:
+            chunk = data.read(min(length - read, 1024 * 1024))
+            if not chunk:
+                break
+            read += len(chunk)
+        self.objects[f"{bucket_name}/{object_name}"] = read
+
+    def fput_object(self, bucket_name, object_name, file_path, **kwargs):
+        self.objects[f"{bucket_name}/{object_name}"] = 0
@@ -1,12 +1,28 @@
+-- Сообщения секционированы по хешу chat_id: все сообщения чата лежат в одной секции,
+-- а ключ (chat_id, message_id) уникален внутри чата, как и id сообщений в telegram
 CREATE TABLE IF NOT EXISTS messages (
-    id SERIAL PRIMARY KEY,
+    id BIGSERIAL NOT NULL,
     message_id BIGINT NOT NULL,
     user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-    chat_id BIGINT REFERENCES chats(id) ON DELETE CASCADE,
+    chat_id BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
     message_text TEXT NOT NULL,
     timestamp TIMESTAMP,
     file_url TEXT,
     reply_to_message_id BIGINT,
-    forwarded_from_user_id BIGINT REFERENCES users(id) ON DELETE SET NULL
-);
+    forwarded_from_user_id BIGINT REFERENCES users(id) ON DELETE SET NULL,
+    -- отпечаток текста и дата правки для сверки с telegram, удалённые в telegram сообщения помечаются
+    text_hash BIGINT GENERATED ALWAYS AS (('x' || left(md5(message_text), 16))::bit(64)::bigint) STORED,
+    edit_date TIMESTAMP,
+    deleted BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (chat_id, message_id)
+) PARTITION BY HASH (chat_id);
 
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS messages_p%s PARTITION OF messages FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+            i, i
+        );
+    END LOOP;
+END $$;
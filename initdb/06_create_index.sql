@@ -1,3 +1,12 @@
-CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id);
-CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id);
-CREATE INDEX IF NOT EXISTS idx_messages_user_chat_id ON messages(user_id, chat_id);
\ No newline at end of file
+-- (chat_id, message_id) покрыт первичным ключом, он же обслуживает поиск точки возобновления
+CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages(chat_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp ON messages(user_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_forwarded_from_user_id ON messages(forwarded_from_user_id)
+    WHERE forwarded_from_user_id IS NOT NULL;
+-- отпечатки последних сообщений чата читаются сверкой без обращения к таблице
+CREATE INDEX IF NOT EXISTS idx_messages_fingerprint ON messages(chat_id, message_id DESC)
+    INCLUDE (text_hash, edit_date) WHERE NOT deleted;
+-- полнотекстовый поиск, запросы должны использовать то же выражение to_tsvector('simple', message_text)
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (to_tsvector('simple', message_text));
+
+CREATE INDEX IF NOT EXISTS idx_user_chat_chat_id ON user_chat(chat_id);
@@ -0,0 +1,13 @@
+-- Точка возобновления сбора для каждого чата и топика форума (topic_id = 0 для обычных чатов)
+CREATE TABLE IF NOT EXISTS scrape_state (
+    chat_id BIGINT REFERENCES chats(id) ON DELETE CASCADE,
+    topic_id BIGINT NOT NULL DEFAULT 0,
+    last_message_id BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, topic_id)
+);
+
+-- Перенос точек возобновления для уже собранных чатов
+INSERT INTO scrape_state (chat_id, topic_id, last_message_id)
+SELECT chat_id, 0, MAX(message_id) FROM messages GROUP BY chat_id
+ON CONFLICT DO NOTHING;
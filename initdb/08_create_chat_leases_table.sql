@@ -0,0 +1,19 @@
+-- Аренда чатов воркерами: чат обрабатывает тот воркер, чья аренда не истекла
+CREATE TABLE IF NOT EXISTS chat_leases (
+    chat_id BIGINT PRIMARY KEY REFERENCES chats(id) ON DELETE CASCADE,
+    worker BIGINT,
+    lease_expires_at TIMESTAMP,
+    backlog BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_leases_worker ON chat_leases(worker);
+
+CREATE TABLE IF NOT EXISTS workers (
+    id BIGINT PRIMARY KEY,
+    heartbeat_at TIMESTAMP NOT NULL,
+    flood_wait_until TIMESTAMP
+);
+
+INSERT INTO chat_leases (chat_id, worker)
+SELECT id, worker FROM chats
+ON CONFLICT DO NOTHING;
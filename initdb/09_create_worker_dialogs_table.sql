@@ -0,0 +1,6 @@
+-- Чаты, в которых состоит аккаунт воркера, чтобы не перебирать все диалоги при каждой проверке
+CREATE TABLE IF NOT EXISTS worker_dialogs (
+    worker BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    PRIMARY KEY (worker, chat_id)
+);
@@ -0,0 +1,10 @@
+-- Загруженные в MinIO медиафайлы: один объект на документ telegram и на содержимое
+CREATE TABLE IF NOT EXISTS media_objects (
+    document_id BIGINT PRIMARY KEY,
+    sha256 CHAR(64) NOT NULL,
+    file_url TEXT NOT NULL,
+    size BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_media_objects_sha256 ON media_objects(sha256);
@@ -0,0 +1,13 @@
+-- Диапазоны id сообщений для параллельной загрузки истории больших чатов: [start_id, end_id)
+CREATE TABLE IF NOT EXISTS backfill_ranges (
+    chat_id BIGINT REFERENCES chats(id) ON DELETE CASCADE,
+    start_id BIGINT NOT NULL,
+    end_id BIGINT NOT NULL,
+    last_message_id BIGINT NOT NULL,
+    done BOOLEAN NOT NULL DEFAULT FALSE,
+    worker BIGINT,
+    lease_expires_at TIMESTAMP,
+    PRIMARY KEY (chat_id, start_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_backfill_ranges_pending ON backfill_ranges(chat_id) WHERE NOT done;
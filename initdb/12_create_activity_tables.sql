@@ -0,0 +1,33 @@
+-- Сводки активности по пользователям и чатам, пополняются в той же транзакции, что и пачка сообщений
+CREATE TABLE IF NOT EXISTS user_chat_activity (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    message_count BIGINT NOT NULL DEFAULT 0,
+    first_message_at TIMESTAMP,
+    last_message_at TIMESTAMP,
+    PRIMARY KEY (user_id, chat_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_chat_activity_chat ON user_chat_activity(chat_id, message_count DESC);
+
+CREATE TABLE IF NOT EXISTS chat_activity (
+    chat_id BIGINT PRIMARY KEY REFERENCES chats(id) ON DELETE CASCADE,
+    message_count BIGINT NOT NULL DEFAULT 0,
+    user_count BIGINT NOT NULL DEFAULT 0,
+    first_message_at TIMESTAMP,
+    last_message_at TIMESTAMP
+);
+
+-- Заполнение сводок для уже собранных сообщений
+INSERT INTO user_chat_activity (user_id, chat_id, message_count, first_message_at, last_message_at)
+SELECT user_id, chat_id, count(*), min(timestamp), max(timestamp)
+FROM messages
+WHERE user_id IS NOT NULL
+GROUP BY user_id, chat_id
+ON CONFLICT DO NOTHING;
+
+INSERT INTO chat_activity (chat_id, message_count, user_count, first_message_at, last_message_at)
+SELECT chat_id, sum(message_count), count(*), min(first_message_at), max(last_message_at)
+FROM user_chat_activity
+GROUP BY chat_id
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,9 @@
+-- Последний выгруженный id для инкрементальной выгрузки таблиц в Parquet
+CREATE TABLE IF NOT EXISTS export_watermarks (
+    name VARCHAR(64) PRIMARY KEY,
+    last_id BIGINT NOT NULL,
+    exported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- id растёт в порядке вставки, BRIN по нему почти ничего не стоит при записи
+CREATE INDEX IF NOT EXISTS idx_messages_id_brin ON messages USING BRIN (id);
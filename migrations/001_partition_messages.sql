@@ -0,0 +1,64 @@
+-- Moves an existing database from the single-heap messages table to the partitioned
+-- schema of initdb/05_create_messages_table.sql and initdb/06_create_index.sql.
+--
+--     psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -v ON_ERROR_STOP=1 -f migrations/001_partition_messages.sql
+--
+-- Stop all workers first: the table is rewritten in one transaction. Rows duplicated
+-- within a chat are collapsed, keeping the first stored copy.
+SET lock_timeout = 0;
+SET statement_timeout = 0;
+
+BEGIN;
+
+ALTER TABLE messages RENAME TO messages_old;
+ALTER SEQUENCE messages_id_seq RENAME TO messages_old_id_seq;
+DROP INDEX IF EXISTS idx_messages_user_id;
+DROP INDEX IF EXISTS idx_messages_chat_id;
+DROP INDEX IF EXISTS idx_messages_user_chat_id;
+DROP INDEX IF EXISTS idx_messages_chat_message_id;
+
+CREATE TABLE messages (
+    id BIGSERIAL NOT NULL,
+    message_id BIGINT NOT NULL,
+    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+    chat_id BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    message_text TEXT NOT NULL,
+    timestamp TIMESTAMP,
+    file_url TEXT,
+    reply_to_message_id BIGINT,
+    forwarded_from_user_id BIGINT REFERENCES users(id) ON DELETE SET NULL,
+    PRIMARY KEY (chat_id, message_id)
+) PARTITION BY HASH (chat_id);
+
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE messages_p%s PARTITION OF messages FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+            i, i
+        );
+    END LOOP;
+END $$;
+
+INSERT INTO messages (id, message_id, user_id, chat_id, message_text, timestamp, file_url,
+                      reply_to_message_id, forwarded_from_user_id)
+SELECT DISTINCT ON (chat_id, message_id)
+       id, message_id, user_id, chat_id, message_text, timestamp, file_url,
+       reply_to_message_id, forwarded_from_user_id
+FROM messages_old
+WHERE chat_id IS NOT NULL
+ORDER BY chat_id, message_id, id;
+
+SELECT setval(pg_get_serial_sequence('messages', 'id'), COALESCE((SELECT MAX(id) FROM messages), 0) + 1, false);
+
+CREATE INDEX idx_messages_chat_timestamp ON messages(chat_id, timestamp DESC);
+CREATE INDEX idx_messages_user_timestamp ON messages(user_id, timestamp DESC);
+CREATE INDEX idx_messages_forwarded_from_user_id ON messages(forwarded_from_user_id)
+    WHERE forwarded_from_user_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_user_chat_chat_id ON user_chat(chat_id);
+
+DROP TABLE messages_old;
+
+COMMIT;
+
+ANALYZE messages;
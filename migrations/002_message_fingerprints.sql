@@ -0,0 +1,22 @@
+-- Adds the reconciliation columns of initdb/05_create_messages_table.sql to an existing
+-- messages table.
+--
+--     psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -v ON_ERROR_STOP=1 -f migrations/002_message_fingerprints.sql
+--
+-- The stored text_hash column rewrites every partition, stop all workers first.
+SET lock_timeout = 0;
+SET statement_timeout = 0;
+
+BEGIN;
+
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS text_hash BIGINT GENERATED ALWAYS AS (('x' || left(md5(message_text), 16))::bit(64)::bigint) STORED,
+    ADD COLUMN IF NOT EXISTS edit_date TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS deleted BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_messages_fingerprint ON messages(chat_id, message_id DESC)
+    INCLUDE (text_hash, edit_date) WHERE NOT deleted;
+
+COMMIT;
+
+ANALYZE messages;
@@ -0,0 +1,17 @@
+-- Adds the full-text search index of initdb/06_create_index.sql and the activity summary
+-- tables of initdb/12_create_activity_tables.sql to an existing database, seeding the
+-- summaries from the stored messages.
+--
+--     psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -v ON_ERROR_STOP=1 -f migrations/003_search_and_activity.sql
+--
+-- Stop all workers first: messages rows written while the summaries are seeded would be
+-- counted twice.
+SET lock_timeout = 0;
+SET statement_timeout = 0;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (to_tsvector('simple', message_text));
+
+\ir ../initdb/12_create_activity_tables.sql
+
+ANALYZE user_chat_activity;
+ANALYZE chat_activity;
@@ -0,0 +1,24 @@
+-- Adds the tables of initdb/07_create_scrape_state_table.sql to
+-- initdb/13_create_export_watermarks_table.sql (except the activity tables of
+-- migrations/003_search_and_activity.sql) to an existing database, seeding scrape_state
+-- from the stored messages and chat_leases from the worker column of chats.
+--
+--     psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -v ON_ERROR_STOP=1 -f migrations/004_worker_tables.sql
+--
+-- Stop all workers first: they need scrape_state and chat_leases as soon as they start.
+SET lock_timeout = 0;
+SET statement_timeout = 0;
+
+BEGIN;
+
+\ir ../initdb/07_create_scrape_state_table.sql
+\ir ../initdb/08_create_chat_leases_table.sql
+\ir ../initdb/09_create_worker_dialogs_table.sql
+\ir ../initdb/10_create_media_objects_table.sql
+\ir ../initdb/11_create_backfill_ranges_table.sql
+\ir ../initdb/13_create_export_watermarks_table.sql
+
+COMMIT;
+
+ANALYZE scrape_state;
+ANALYZE chat_leases;